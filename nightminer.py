@@ -38,7 +38,7 @@
 #   Scrypt Algorithm        - http://www.tarsnap.com/scrypt/scrypt.pdf
 #   Scrypt Implementation   - https://code.google.com/p/scrypt/source/browse/trunk/lib/crypto/crypto_scrypt-ref.c
 
-import base64, binascii, json, hashlib, hmac, math, socket, struct, sys, threading, time, urlparse
+import base64, json, hashlib, hmac, math, os, random, socket, struct, sys, threading, time, timeit, urllib.error, urllib.parse, urllib.request
 
 # DayMiner (ah-ah-ah), fighter of the...
 USER_AGENT = "NightMiner"
@@ -46,6 +46,9 @@ VERSION = [0, 1]
 
 # You're a master of Karate and friendship for everyone.
 
+# When we were launched (for measuring time-to-first-share)
+START_TIME = time.time()
+
 
 # Which algorithm for proof-of-work to use
 ALGORITHM_SCRYPT      = 'scrypt'
@@ -68,9 +71,43 @@ LEVEL_ERROR     = 'error'
 # These control which scrypt implementation to use
 SCRYPT_LIBRARY_AUTO     = 'auto'
 SCRYPT_LIBRARY_LTC      = 'ltc_scrypt (https://github.com/forrestv/p2pool)'
+SCRYPT_LIBRARY_HASHLIB  = 'hashlib.scrypt (OpenSSL 1.1+)'
 SCRYPT_LIBRARY_SCRYPT   = 'scrypt (https://pypi.python.org/pypi/scrypt/)'
 SCRYPT_LIBRARY_PYTHON   = 'pure python'
-SCRYPT_LIBRARIES = [ SCRYPT_LIBRARY_AUTO, SCRYPT_LIBRARY_LTC, SCRYPT_LIBRARY_SCRYPT, SCRYPT_LIBRARY_PYTHON ]
+SCRYPT_LIBRARIES = [ SCRYPT_LIBRARY_AUTO, SCRYPT_LIBRARY_LTC, SCRYPT_LIBRARY_HASHLIB, SCRYPT_LIBRARY_SCRYPT, SCRYPT_LIBRARY_PYTHON ]
+
+# Scrypt libraries which have passed test_subscription (so need not be tested again)
+SELF_TEST_CACHE = os.path.join(os.path.expanduser('~'), '.nightminer-selftest.json')
+
+
+# Why a share was dropped before being submitted
+SHARE_STALE             = 'stale'             # Its job has been superseded (clean_jobs)
+SHARE_LOW_DIFFICULTY    = 'low-difficulty'    # The difficulty was raised since the job started
+SHARE_INVALID           = 'invalid'           # The reference proof-of-work disagrees
+
+
+# Job and share lifecycle stages for tracing (see set_trace_file)
+TRACE_NOTIFY_RECEIVED   = 'notify_received'   # The bytes of a mining.notify arrived
+TRACE_NOTIFY_PARSED     = 'notify_parsed'     # ...and were parsed as JSON
+TRACE_JOB_CREATED       = 'job_created'       # ...and the Job was created
+TRACE_FIRST_HASH        = 'first_hash'        # A thread started hashing the job
+TRACE_SHARE_FOUND       = 'share_found'       # A share was found (key = submit request id)
+TRACE_SUBMIT_WRITTEN    = 'submit_written'    # ...and its mining.submit written to the socket
+TRACE_SUBMIT_REPLY      = 'submit_reply'      # ...and the server replied
+
+# The latencies reported by trace_summary; (name, from stage, to stage)
+TRACE_LATENCIES = [
+  ('parse', TRACE_NOTIFY_RECEIVED, TRACE_NOTIFY_PARSED),
+  ('create job', TRACE_NOTIFY_PARSED, TRACE_JOB_CREATED),
+  ('start hashing', TRACE_JOB_CREATED, TRACE_FIRST_HASH),
+  ('job switch (total)', TRACE_NOTIFY_RECEIVED, TRACE_FIRST_HASH),
+  ('submit', TRACE_SHARE_FOUND, TRACE_SUBMIT_WRITTEN),
+  ('server reply', TRACE_SUBMIT_WRITTEN, TRACE_SUBMIT_REPLY),
+  ('share (total)', TRACE_SHARE_FOUND, TRACE_SUBMIT_REPLY),
+]
+
+TRACE_FILE = None
+TRACE_LOCK = threading.Lock()
 
 
 def log(message, level):
@@ -89,9 +126,76 @@ def log(message, level):
   print ("[%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), message))
 
 
-# Convert from/to binary and hexidecimal strings (could be replaced with .encode('hex') and .decode('hex'))
-hexlify = binascii.hexlify
-unhexlify = binascii.unhexlify
+def set_trace_file(filename):
+  '''Appends job and share lifecycle traces to filename (None to stop tracing).
+
+     Each line is "timestamp,stage,job_id,key"; see trace_summary.
+  '''
+
+  global TRACE_FILE
+
+  with TRACE_LOCK:
+    if TRACE_FILE: TRACE_FILE.close()
+    TRACE_FILE = None
+    if filename: TRACE_FILE = open(filename, 'a')
+
+
+def trace(stage, job_id, key = '', timestamp = None):
+  '''Records that job_id (or the share key of job_id) reached stage.'''
+
+  if TRACE_FILE is None: return
+
+  if timestamp is None: timestamp = time.time()
+  with TRACE_LOCK:
+    if TRACE_FILE is None: return
+    TRACE_FILE.write('%.6f,%s,%s,%s\n' % (timestamp, stage, job_id, key))
+    TRACE_FILE.flush()
+
+
+def trace_summary(filename):
+  '''Returns the percentile latencies for each of TRACE_LATENCIES in a trace file,
+     as a list of (name, count, p50, p90, p99, max), in seconds.'''
+
+  # The first time each (job_id, key) reached each stage
+  times = dict()
+  for line in open(filename):
+    try:
+      (timestamp, stage, job_id, key) = line.rstrip('\n').split(',', 3)
+      timestamp = float(timestamp)
+    except Exception as e:
+      continue
+
+    stages = times.setdefault((job_id, key), dict())
+    if stage not in stages or timestamp < stages[stage]:
+      stages[stage] = timestamp
+
+  # Job stages are keyed by job_id alone
+  job_times = dict((job_id, stages) for ((job_id, key), stages) in times.items() if key == '')
+
+  def percentile(values, p):
+    return values[min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+  summary = [ ]
+  for (name, start, end) in TRACE_LATENCIES:
+    latencies = [ ]
+    for ((job_id, key), stages) in times.items():
+      # Share stages are compared against their job's stages if need be
+      first = stages.get(start, job_times.get(job_id, { }).get(start))
+      if first is None or end not in stages: continue
+      latencies.append(stages[end] - first)
+
+    latencies.sort()
+    if latencies:
+      summary.append((name, len(latencies), percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99), latencies[-1]))
+    else:
+      summary.append((name, 0, None, None, None, None))
+
+  return summary
+
+
+# Convert from/to binary (bytes) and hexidecimal strings (str)
+hexlify = bytes.hex
+unhexlify = bytes.fromhex
 
 
 def sha256d(message):
@@ -113,7 +217,8 @@ def swap_endian_words(hex_words):
 
   message = unhexlify(hex_words)
   if len(message) % 4 != 0: raise ValueError('Must be 4-byte word aligned')
-  return ''.join([ message[4 * i: 4 * i + 4][::-1] for i in range(0, len(message) // 4) ])
+  count = len(message) // 4
+  return struct.pack('<%dI' % count, *struct.unpack('>%dI' % count, message))
 
 
 def human_readable_hashrate(hashrate):
@@ -128,213 +233,389 @@ def human_readable_hashrate(hashrate):
   return '%2f Ghashes/s' % (hashrate / 1000000000)
 
 
-def scrypt(password, salt, N, r, p, dkLen):
-  """Returns the result of the scrypt password-based key derivation function.
+def set_thread_affinity(cpus):
+  '''Pins the calling thread to the given CPUs (Linux only).'''
 
-     This is used as the foundation of the proof-of-work for litecoin and other
-     scrypt-based coins, using the parameters:
-       password = bloack_header
-       salt     = block_header
-       N        = 1024
-       r        = 1
-       p        = 1
-       dkLen    = 256 bits (=32 bytes)
+  cpus = list(cpus)
 
-     Please note, that this is a pure Python implementation, and is slow. VERY
-     slow. It is meant only for completeness of a pure-Python, one file stratum
-     server for Litecoin.
+  if hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, cpus)
+    return
 
-     I have included the ltc_scrypt C-binding from p2pool (https://github.com/forrestv/p2pool)
-     which is several thousand times faster. The server will automatically attempt to load
-     the faster module (use set_scrypt_library to choose a specific library).
-   """
+  # Older Pythons do not expose sched_setaffinity; go straight to libc
+  import ctypes, ctypes.util
 
-  def array_overwrite(source, source_start, dest, dest_start, length):
-    '''Overwrites the dest array with the source array.'''
+  libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+  if not hasattr(libc, 'sched_setaffinity'):
+    raise OSError('CPU affinity is not supported on this platform')
 
-    for i in xrange(0, length):
-      dest[dest_start + i] = source[source_start + i]
+  mask = (ctypes.c_ubyte * 128)()
+  for cpu in cpus:
+    mask[cpu // 8] |= 1 << (cpu % 8)
 
+  if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+    raise OSError(ctypes.get_errno(), 'sched_setaffinity failed')
 
-  def blockxor(source, source_start, dest, dest_start, length):
-    '''Performs xor on arrays source and dest, storing the result back in dest.'''
 
-    for i in xrange(0, length):
-      dest[dest_start + i] = chr(ord(dest[dest_start + i]) ^ ord(source[source_start + i]))
+def set_thread_priority(nice = None, idle = False):
+  '''Lowers the calling thread's CPU priority (on Linux these are per-thread).
 
+     nice is an increment (as for os.nice); idle uses the SCHED_IDLE class where
+     available, so the thread only runs when nothing else wants the CPU.
+  '''
 
-  def pbkdf2(passphrase, salt, count, dkLen, prf):
-    '''Returns the result of the Password-Based Key Derivation Function 2.
+  if idle:
+    if hasattr(os, 'sched_setscheduler'):
+      os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    else:
+      # The next best thing
+      nice = 19
 
-       See http://en.wikipedia.org/wiki/PBKDF2
-    '''
+  if nice:
+    os.nice(nice)
+
+
+class DutyCycle(object):
+  '''Throttles a hashing thread to a fraction (duty) of a CPU.
+
+     After every period * duty seconds of hashing, the thread sleeps long enough
+     to bring it back to duty. This is meant to be called from inside the hashing
+     loop; check() returns how many hashes to do before calling it again, which
+     adapts so the clock is only read a few times per busy slice.
+  '''
+
+  def __init__(self, duty, period = 0.1):
+    if not (0 < duty <= 1): raise ValueError('Duty cycle must be in (0, 1]')
+
+    self._duty = duty
+    self._period = period
+
+    self._interval = 1
+    self._busy = 0.0
+    self._t0 = None
+
+  duty = property(lambda s: s._duty)
+
+
+  def check(self):
+    now = time.time()
+    if self._t0 is None:
+      self._t0 = now
+      return self._interval
+
+    # Aim to check about 10 times per busy slice
+    slice = self._period * self._duty
+    step = now - self._t0
+    if step < slice / 20:
+      self._interval *= 2
+    elif step > slice / 5 and self._interval > 1:
+      self._interval //= 2
+
+    self._busy += step
+    if self._busy >= slice:
+      time.sleep(self._busy * (1 - self._duty) / self._duty)
+      self._busy = 0.0
+      now = time.time()
+
+    self._t0 = now
+    return self._interval
+
+
+# The building blocks of scrypt (see the scrypt function below); arrays are
+# bytearrays (or bytes, if only read)
+
+def array_overwrite(source, source_start, dest, dest_start, length):
+  '''Overwrites the dest array with the source array.'''
+
+  dest[dest_start:dest_start + length] = source[source_start:source_start + length]
+
+
+def blockxor(source, source_start, dest, dest_start, length):
+  '''Performs xor on arrays source and dest, storing the result back in dest.'''
+
+  # One big integer xor is far quicker than xor-ing each byte
+  x = int.from_bytes(dest[dest_start:dest_start + length], 'little') ^ int.from_bytes(source[source_start:source_start + length], 'little')
+  dest[dest_start:dest_start + length] = x.to_bytes(length, 'little')
 
-    def f(block_number):
-      '''The function "f".'''
 
-      U = prf(passphrase, salt + struct.pack('>L', block_number))
+def pbkdf2(passphrase, salt, count, dkLen, prf):
+  '''Returns the result of the Password-Based Key Derivation Function 2.
 
-      # Not used for scrpyt-based coins, could be removed, but part of a more general solution
-      if count > 1:
-        U = [ c for c in U ]
-        for i in xrange(2, 1 + count):
-          blockxor(prf(passphrase, ''.join(U)), 0, U, 0, len(U))
-        U = ''.join(U)
+     See http://en.wikipedia.org/wiki/PBKDF2
+  '''
+
+  def f(block_number):
+    '''The function "f".'''
+
+    U = prf(passphrase, salt + struct.pack('>L', block_number))
+
+    # Not used for scrpyt-based coins, could be removed, but part of a more general solution
+    if count > 1:
+      U = bytearray(U)
+      for i in range(2, 1 + count):
+        blockxor(prf(passphrase, bytes(U)), 0, U, 0, len(U))
+      U = bytes(U)
 
-      return U
+    return U
 
-    # PBKDF2 implementation
-    size = 0
+  # PBKDF2 implementation
+  size = 0
 
-    block_number = 0
-    blocks = [ ]
+  block_number = 0
+  blocks = [ ]
 
-    # The iterations
-    while size < dkLen:
-      block_number += 1
-      block = f(block_number)
+  # The iterations
+  while size < dkLen:
+    block_number += 1
+    block = f(block_number)
 
-      blocks.append(block)
-      size += len(block)
+    blocks.append(block)
+    size += len(block)
 
-    return ''.join(blocks)[:dkLen]
+  return b''.join(blocks)[:dkLen]
 
-  def integerify(B, Bi, r):
-    '''"A bijective function from ({0, 1} ** k) to {0, ..., (2 ** k) - 1".'''
 
-    Bi += (2 * r - 1) * 64
-    n  = ord(B[Bi]) | (ord(B[Bi + 1]) << 8) | (ord(B[Bi + 2]) << 16) | (ord(B[Bi + 3]) << 24)
-    return n
+def integerify(B, Bi, r):
+  '''"A bijective function from ({0, 1} ** k) to {0, ..., (2 ** k) - 1".'''
 
+  Bi += (2 * r - 1) * 64
+  return int.from_bytes(B[Bi:Bi + 4], 'little')
 
-  def make_int32(v):
-    '''Converts (truncates, two's compliments) a number to an int32.'''
 
-    if v > 0x7fffffff: return -1 * ((~v & 0xffffffff) + 1)
-    return v
+def R(X, destination, a1, a2, b):
+  '''A single round of Salsa (bits above 32 are left for salsa20_8 to mask).'''
 
+  a = (X[a1] + X[a2]) & 0xffffffff
+  X[destination] ^= ((a << b) | (a >> (32 - b)))
 
-  def R(X, destination, a1, a2, b):
-    '''A single round of Salsa.'''
 
-    a = (X[a1] + X[a2]) & 0xffffffff
-    X[destination] ^= ((a << b) | (a >> (32 - b)))
+def salsa20_8(B):
+  '''Salsa 20/8 stream cypher; Used by BlockMix. See http://en.wikipedia.org/wiki/Salsa20'''
 
+  # Convert the byte array into a uint32 array
+  B32 = struct.unpack('<16I', B)
+  x = list(B32)
 
-  def salsa20_8(B):
-    '''Salsa 20/8 stream cypher; Used by BlockMix. See http://en.wikipedia.org/wiki/Salsa20'''
+  # Salsa... Time to dance.
+  for i in range(8, 0, -2):
+    R(x, 4, 0, 12, 7);   R(x, 8, 4, 0, 9);    R(x, 12, 8, 4, 13);   R(x, 0, 12, 8, 18)
+    R(x, 9, 5, 1, 7);    R(x, 13, 9, 5, 9);   R(x, 1, 13, 9, 13);   R(x, 5, 1, 13, 18)
+    R(x, 14, 10, 6, 7);  R(x, 2, 14, 10, 9);  R(x, 6, 2, 14, 13);   R(x, 10, 6, 2, 18)
+    R(x, 3, 15, 11, 7);  R(x, 7, 3, 15, 9);   R(x, 11, 7, 3, 13);   R(x, 15, 11, 7, 18)
+    R(x, 1, 0, 3, 7);    R(x, 2, 1, 0, 9);    R(x, 3, 2, 1, 13);    R(x, 0, 3, 2, 18)
+    R(x, 6, 5, 4, 7);    R(x, 7, 6, 5, 9);    R(x, 4, 7, 6, 13);    R(x, 5, 4, 7, 18)
+    R(x, 11, 10, 9, 7);  R(x, 8, 11, 10, 9);  R(x, 9, 8, 11, 13);   R(x, 10, 9, 8, 18)
+    R(x, 12, 15, 14, 7); R(x, 13, 12, 15, 9); R(x, 14, 13, 12, 13); R(x, 15, 14, 13, 18)
 
-    # Convert the character array into an int32 array
-    B32 = [ make_int32((ord(B[i * 4]) | (ord(B[i * 4 + 1]) << 8) | (ord(B[i * 4 + 2]) << 16) | (ord(B[i * 4 + 3]) << 24))) for i in xrange(0, 16) ]
-    x = [ i for i in B32 ]
+  # Coerce into nice happy 32-bit integers, and convert back to bytes
+  B[:] = struct.pack('<16I', *[ (x[i] + B32[i]) & 0xffffffff for i in range(0, 16) ])
 
-    # Salsa... Time to dance.
-    for i in xrange(8, 0, -2):
-      R(x, 4, 0, 12, 7);   R(x, 8, 4, 0, 9);    R(x, 12, 8, 4, 13);   R(x, 0, 12, 8, 18)
-      R(x, 9, 5, 1, 7);    R(x, 13, 9, 5, 9);   R(x, 1, 13, 9, 13);   R(x, 5, 1, 13, 18)
-      R(x, 14, 10, 6, 7);  R(x, 2, 14, 10, 9);  R(x, 6, 2, 14, 13);   R(x, 10, 6, 2, 18)
-      R(x, 3, 15, 11, 7);  R(x, 7, 3, 15, 9);   R(x, 11, 7, 3, 13);   R(x, 15, 11, 7, 18)
-      R(x, 1, 0, 3, 7);    R(x, 2, 1, 0, 9);    R(x, 3, 2, 1, 13);    R(x, 0, 3, 2, 18)
-      R(x, 6, 5, 4, 7);    R(x, 7, 6, 5, 9);    R(x, 4, 7, 6, 13);    R(x, 5, 4, 7, 18)
-      R(x, 11, 10, 9, 7);  R(x, 8, 11, 10, 9);  R(x, 9, 8, 11, 13);   R(x, 10, 9, 8, 18)
-      R(x, 12, 15, 14, 7); R(x, 13, 12, 15, 9); R(x, 14, 13, 12, 13); R(x, 15, 14, 13, 18)
 
-    # Coerce into nice happy 32-bit integers
-    B32 = [ make_int32(x[i] + B32[i]) for i in xrange(0, 16) ]
+def blockmix_salsa8(BY, Bi, Yi, r):
+  '''Blockmix; Used by SMix.'''
 
-    # Convert back to bytes
-    for i in xrange(0, 16):
-      B[i * 4 + 0] = chr((B32[i] >> 0) & 0xff)
-      B[i * 4 + 1] = chr((B32[i] >> 8) & 0xff)
-      B[i * 4 + 2] = chr((B32[i] >> 16) & 0xff)
-      B[i * 4 + 3] = chr((B32[i] >> 24) & 0xff)
+  start = Bi + (2 * r - 1) * 64
+  X = BY[start:start + 64]                                           # BlockMix - 1
 
+  for i in range(0, 2 * r):                                          # BlockMix - 2
+    blockxor(BY, i * 64, X, 0, 64)                                   # BlockMix - 3(inner)
+    salsa20_8(X)                                                     # BlockMix - 3(outer)
+    array_overwrite(X, 0, BY, Yi + (i * 64), 64)                     # BlockMix - 4
 
-  def blockmix_salsa8(BY, Bi, Yi, r):
-    '''Blockmix; Used by SMix.'''
+  for i in range(0, r):                                              # BlockMix - 6 (and below)
+    array_overwrite(BY, Yi + (i * 2) * 64, BY, Bi + (i * 64), 64)
 
-    start = Bi + (2 * r - 1) * 64
-    X = [ BY[i] for i in xrange(start, start + 64) ]                   # BlockMix - 1
+  for i in range(0, r):
+    array_overwrite(BY, Yi + (i * 2 + 1) * 64, BY, Bi + (i + r) * 64, 64)
 
-    for i in xrange(0, 2 * r):                                         # BlockMix - 2
-      blockxor(BY, i * 64, X, 0, 64)                                   # BlockMix - 3(inner)
-      salsa20_8(X)                                                     # BlockMix - 3(outer)
-      array_overwrite(X, 0, BY, Yi + (i * 64), 64)                     # BlockMix - 4
 
-    for i in xrange(0, r):                                             # BlockMix - 6 (and below)
-      array_overwrite(BY, Yi + (i * 2) * 64, BY, Bi + (i * 64), 64)
+def smix(B, Bi, r, N, V, X):
+  '''SMix; a specific case of ROMix. See scrypt.pdf in the links above.'''
 
-    for i in xrange(0, r):
-      array_overwrite(BY, Yi + (i * 2 + 1) * 64, BY, Bi + (i + r) * 64, 64)
+  array_overwrite(B, Bi, X, 0, 128 * r)               # ROMix - 1
 
+  for i in range(0, N):                               # ROMix - 2
+    array_overwrite(X, 0, V, i * (128 * r), 128 * r)  # ROMix - 3
+    blockmix_salsa8(X, 0, 128 * r, r)                 # ROMix - 4
 
-  def smix(B, Bi, r, N, V, X):
-    '''SMix; a specific case of ROMix. See scrypt.pdf in the links above.'''
+  for i in range(0, N):                               # ROMix - 6
+    j = integerify(X, 0, r) & (N - 1)                 # ROMix - 7
+    blockxor(V, j * (128 * r), X, 0, 128 * r)         # ROMix - 8(inner)
+    blockmix_salsa8(X, 0, 128 * r, r)                 # ROMix - 9(outer)
 
-    array_overwrite(B, Bi, X, 0, 128 * r)               # ROMix - 1
+  array_overwrite(X, 0, B, Bi, 128 * r)               # ROMix - 10
 
-    for i in xrange(0, N):                              # ROMix - 2
-      array_overwrite(X, 0, V, i * (128 * r), 128 * r)  # ROMix - 3
-      blockmix_salsa8(X, 0, 128 * r, r)                 # ROMix - 4
 
-    for i in xrange(0, N):                              # ROMix - 6
-      j = integerify(X, 0, r) & (N - 1)                 # ROMix - 7
-      blockxor(V, j * (128 * r), X, 0, 128 * r)         # ROMix - 8(inner)
-      blockmix_salsa8(X, 0, 128 * r, r)                 # ROMix - 9(outer)
+def scrypt(password, salt, N, r, p, dkLen):
+  """Returns the result of the scrypt password-based key derivation function.
+
+     This is used as the foundation of the proof-of-work for litecoin and other
+     scrypt-based coins, using the parameters:
+       password = bloack_header
+       salt     = block_header
+       N        = 1024
+       r        = 1
+       p        = 1
+       dkLen    = 256 bits (=32 bytes)
 
-    array_overwrite(X, 0, B, Bi, 128 * r)               # ROMix - 10
+     Please note, that this is a pure Python implementation, and is slow. VERY
+     slow. It is meant only for completeness of a pure-Python, one file stratum
+     server for Litecoin.
 
+     I have included the ltc_scrypt C-binding from p2pool (https://github.com/forrestv/p2pool)
+     which is several thousand times faster. The server will automatically attempt to load
+     the faster module (use set_scrypt_library to choose a specific library).
+   """
 
   # Scrypt implementation. Significant thanks to https://github.com/wg/scrypt
   if N < 2 or (N & (N - 1)): raise ValueError('Scrypt N must be a power of 2 greater than 1')
 
   prf = lambda k, m: hmac.new(key = k, msg = m, digestmod = hashlib.sha256).digest()
 
-  DK = [ chr(0) ] * dkLen
+  B  = bytearray(pbkdf2(password, salt, 1, p * 128 * r, prf))
+  XY = bytearray(256 * r)
+  V  = bytearray(128 * r * N)
 
-  B  = [ c for c in pbkdf2(password, salt, 1, p * 128 * r, prf) ]
-  XY = [ chr(0) ] * (256 * r)
-  V  = [ chr(0) ] * (128 * r * N)
-
-  for i in xrange(0, p):
+  for i in range(0, p):
     smix(B, i * 128 * r, r, N, V, XY)
 
-  return pbkdf2(password, ''.join(B), 1, dkLen, prf)
+  return pbkdf2(password, bytes(B), 1, dkLen, prf)
 
 
-SCRYPT_LIBRARY = None
-scrypt_proof_of_work = None
-def set_scrypt_library(library = SCRYPT_LIBRARY_AUTO):
-  '''Sets the scrypt library implementation to use.'''
+def load_scrypt_library(library = SCRYPT_LIBRARY_AUTO):
+  '''Imports a scrypt library implementation, returning (library, proof_of_work).
 
-  global SCRYPT_LIBRARY
-  global scrypt_proof_of_work
+     This does not change the library in use (see set_scrypt_library).
+  '''
 
   if library == SCRYPT_LIBRARY_LTC:
     import ltc_scrypt
-    scrypt_proof_of_work = ltc_scrypt.getPoWHash
-    SCRYPT_LIBRARY = library
+    return (library, ltc_scrypt.getPoWHash)
+
+  elif library == SCRYPT_LIBRARY_HASHLIB:
+    if not hasattr(hashlib, 'scrypt'): raise ImportError('hashlib.scrypt requires OpenSSL 1.1+')
+    hashlib_scrypt = hashlib.scrypt
+    return (library, lambda header: hashlib_scrypt(header, salt = header, n = 1024, r = 1, p = 1, dklen = 32))
 
   elif library == SCRYPT_LIBRARY_SCRYPT:
     import scrypt as NativeScrypt
-    scrypt_proof_of_work = lambda header: NativeScrypt.hash(header, header, 1024, 1, 1, 32)
-    SCRYPT_LIBRARY = library
+    return (library, lambda header: NativeScrypt.hash(header, header, 1024, 1, 1, 32))
 
   # Try to load a faster version of scrypt before using the pure-Python implementation
   elif library == SCRYPT_LIBRARY_AUTO:
     try:
-      set_scrypt_library(SCRYPT_LIBRARY_LTC)
-    except Exception, e:
+      return load_scrypt_library(SCRYPT_LIBRARY_LTC)
+    except Exception as e:
       try:
-        set_scrypt_library(SCRYPT_LIBRARY_SCRYPT)
-      except Exception, e:
-        set_scrypt_library(SCRYPT_LIBRARY_PYTHON)
+        return load_scrypt_library(SCRYPT_LIBRARY_HASHLIB)
+      except Exception as e:
+        try:
+          return load_scrypt_library(SCRYPT_LIBRARY_SCRYPT)
+        except Exception as e:
+          return load_scrypt_library(SCRYPT_LIBRARY_PYTHON)
+
+  return (library, lambda header: scrypt(header, header, 1024, 1, 1, 32))
+
+
+SCRYPT_LIBRARY = None
+SCRYPT_LIBRARY_LOCK = threading.Lock()
+def set_scrypt_library(library = SCRYPT_LIBRARY_AUTO):
+  '''Sets the scrypt library implementation to use.'''
+
+  global SCRYPT_LIBRARY
+  global scrypt_proof_of_work
+
+  (SCRYPT_LIBRARY, scrypt_proof_of_work) = load_scrypt_library(library)
+
+
+def scrypt_proof_of_work(header):
+  '''Replaced by the fastest scrypt library the first time it is used; importing
+     the libraries is deferred so that we can start connecting immediately.'''
+
+  with SCRYPT_LIBRARY_LOCK:
+    if SCRYPT_LIBRARY is None:
+      set_scrypt_library()
+      log('Using scrypt library %r' % SCRYPT_LIBRARY, LEVEL_DEBUG)
+
+  return scrypt_proof_of_work(header)
+
+
+def search_nounces(proof_of_work, header_prefix_bin, target_bin, nounce_start, nounce_stop, nounce_stride = 1):
+  '''Hashes a batch of nounces, returning [ (nounce_bin, pow), ... ] for those
+     whose proof-of-work meets target_bin (the target as 32 big-endian bytes).
+     The pow is hex, like a Job target.'''
+
+  found = [ ]
+  pack = struct.pack
+  for nounce in range(nounce_start, nounce_stop, nounce_stride):
+    nounce_bin = pack('<I', nounce)
+
+    # Equal length bytes compare as big-endian numbers
+    pow_bin = proof_of_work(header_prefix_bin + nounce_bin)[::-1]
+    if pow_bin <= target_bin:
+      found.append((nounce_bin, hexlify(pow_bin)))
+
+  return found
+
+
+# The proof-of-work functions of a ProcessHasher's worker process, by algorithm
+PROCESS_PROOFS_OF_WORK = dict()
+
+def search_nounces_by_algorithm(algorithm, header_prefix_bin, target_bin, nounce_start, nounce_stop, nounce_stride):
+  '''search_nounces, naming the algorithm rather than passing its proof-of-work (which cannot be pickled).'''
+
+  if algorithm not in PROCESS_PROOFS_OF_WORK:
+    PROCESS_PROOFS_OF_WORK[algorithm] = SubscriptionByAlgorithm[algorithm]().ProofOfWork
+
+  return search_nounces(PROCESS_PROOFS_OF_WORK[algorithm], header_prefix_bin, target_bin, nounce_start, nounce_stop, nounce_stride)
+
+
+def set_process_scheduling(counter, cpus, nice, idle):
+  '''Pool initializer for ProcessHasher; pins each new process to the next of
+     cpus (round-robin, using the shared counter) and lowers its priority.'''
+
+  if cpus:
+    with counter.get_lock():
+      index = counter.value
+      counter.value += 1
+
+    try:
+      set_thread_affinity([ cpus[index % len(cpus)] ])
+    except Exception as e:
+      log("ERROR: Could not pin worker process to CPU %d (%s)" % (cpus[index % len(cpus)], e), LEVEL_ERROR)
+
+  try:
+    set_thread_priority(nice = nice, idle = idle)
+  except Exception as e:
+    log("ERROR: Could not set worker process priority (%s)" % e, LEVEL_ERROR)
+
+
+class ProcessHasher(object):
+  '''Hashes batches of nounces in a pool of worker processes, so hashing is not
+     limited by the GIL (see the search argument of Job.mine).
+
+     Each mining thread blocks (without the GIL) while a process hashes its batch,
+     so use as many processes as threads; batches should be large enough that
+     hashing outweighs the round trip to the process.
 
-  else:
-    scrypt_proof_of_work = lambda header: scrypt(header, header, 1024, 1, 1, 32)
-    SCRYPT_LIBRARY = library
+     Each process is pinned to one of cpus (round-robin, if given) and run with
+     the given priority (see set_thread_priority).
+  '''
+
+  def __init__(self, processes, cpus = None, nice = None, idle = False):
+    import multiprocessing
+    counter = multiprocessing.Value('i', 0)
+    self._pool = multiprocessing.Pool(processes, set_process_scheduling, (counter, list(cpus or [ ]), nice, idle))
+
+
+  def searcher(self, algorithm):
+    '''Returns a search function (see Job.mine) which hashes with algorithm in a worker process.'''
 
-set_scrypt_library()
+    return lambda *args: self._pool.apply(search_nounces_by_algorithm, (algorithm, ) + args)
+
+
+  def close(self):
+    self._pool.terminate()
 
 
 class Job(object):
@@ -344,6 +625,9 @@ class Job(object):
            ~Alan Perlis
   '''
 
+  # How long (in seconds) a batch of hashes may grow to take (see mine)
+  BATCH_TIME = 0.01
+
   def __init__(self, job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, target, extranounce1, extranounce2_size, proof_of_work):
 
     # Job parts from the mining.notify command
@@ -387,6 +671,8 @@ class Job(object):
 
   proof_of_work = property(lambda s: s._proof_of_work)
 
+  hash_count = property(lambda s: s._hash_count)
+
 
   @property
   def hashrate(self):
@@ -408,13 +694,45 @@ class Job(object):
     return merkle_root
 
 
+  def extranounce2_bin(self, extranounce2):
+    '''Packs an extranounce2 (an integer) to extranounce2_size bytes.'''
+
+    return struct.pack('<Q', extranounce2)[:self._extranounce2_size].ljust(self._extranounce2_size, b'\0')
+
+
+  def header_prefix_bin(self, extranounce2_bin):
+    '''Builds the block header, up to (but not including) the nounce.'''
+
+    return swap_endian_word(self._version) + swap_endian_words(self._prevhash) + self.merkle_root_bin(extranounce2_bin) + swap_endian_word(self._ntime) + swap_endian_word(self._nbits)
+
+
+  def verify(self, result, proof_of_work = None):
+    '''Recomputes the proof-of-work (as hex) of a result from mine(), using
+       proof_of_work if given (eg. a slower reference implementation).'''
+
+    if proof_of_work is None: proof_of_work = self.proof_of_work
+
+    header_bin = self.header_prefix_bin(unhexlify(result['extranounce2'])) + unhexlify(result['nounce'])[::-1]
+    return hexlify(proof_of_work(header_bin)[::-1])
+
+
   def stop(self):
     '''Requests the mine coroutine stop after its current iteration.'''
 
     self._done = True
 
 
-  def mine(self, nounce_start = 0, nounce_stride = 1):
+  def copy(self):
+    '''Returns a new (not yet started or stopped) Job for the same work.
+
+       Each thread that may be stopped independently needs its own copy, since
+       stop() affects every thread inside mine().
+    '''
+
+    return Job(self._job_id, self._prevhash, self._coinb1, self._coinb2, self._merkle_branches, self._version, self._nbits, self._ntime, self._target, self._extranounce1, self._extranounce2_size, self._proof_of_work)
+
+
+  def mine(self, nounce_start = 0, nounce_stride = 1, extranounce2_start = 0, throttle = None, batch_size = None, search = None):
     '''Returns an iterator that iterates over valid proof-of-work shares.
 
        This is a co-routine; that takes a LONG time; the calling thread should look like:
@@ -425,35 +743,64 @@ class Job(object):
        nounce_start and nounce_stride are useful for multi-processing if you would like
        to assign each process a different starting nounce (0, 1, 2, ...) and a stride
        equal to the number of processes.
+
+       extranounce2_start allows restarting the same job (with a different stride)
+       without repeating work already done at a lower extranounce2.
+
+       throttle is an optional DutyCycle to limit CPU usage.
+
+       Nounces are hashed batch_size at a time (with search, if given, otherwise
+       search_nounces); larger batches spend less time between hashes, but take
+       longer to stop and to yield their shares. By default, batches double in
+       size for as long as they take less than BATCH_TIME.
     '''
 
+    trace(TRACE_FIRST_HASH, self._job_id)
+
+    if search is None:
+      proof_of_work = self.proof_of_work
+      search = lambda *args: search_nounces(proof_of_work, *args)
+
+    adaptive = (batch_size is None)
+    if adaptive: batch_size = 1
+
     t0 = time.time()
+    throttle_countdown = 1
+    target_bin = unhexlify(self.target)
 
     # @TODO: test for extranounce != 0... Do I reverse it or not?
-    for extranounce2 in xrange(0, 0x7fffffff):
+    for extranounce2 in range(extranounce2_start, min(256 ** self._extranounce2_size, 0x7fffffff)):
 
       # Must be unique for any given job id, according to http://mining.bitcoin.cz/stratum-mining/ but never seems enforced?
-      extranounce2_bin = struct.pack('<I', extranounce2)
+      extranounce2_bin = self.extranounce2_bin(extranounce2)
 
-      merkle_root_bin = self.merkle_root_bin(extranounce2_bin)
-      header_prefix_bin = swap_endian_word(self._version) + swap_endian_words(self._prevhash) + merkle_root_bin + swap_endian_word(self._ntime) + swap_endian_word(self._nbits)
-      for nounce in xrange(nounce_start, 0x7fffffff, nounce_stride):
+      header_prefix_bin = self.header_prefix_bin(extranounce2_bin)
+      batch_start = nounce_start
+      while batch_start < 0x7fffffff:
         # This job has been asked to stop
         if self._done:
           self._dt += (time.time() - t0)
-          raise StopIteration()
+          return
+
+        # Give the CPU back if we are over our share
+        if throttle:
+          throttle_countdown -= batch_size
+          if throttle_countdown <= 0: throttle_countdown = throttle.check()
 
-        # Proof-of-work attempt
-        nounce_bin = struct.pack('<I', nounce)
-        pow = self.proof_of_work(header_prefix_bin + nounce_bin)[::-1].encode('hex')
+        # Proof-of-work attempts; did any reach or exceed our target?
+        batch_t0 = time.time()
+        batch_stop = min(batch_start + nounce_stride * batch_size, 0x7fffffff)
+        found = search(header_prefix_bin, target_bin, batch_start, batch_stop, nounce_stride)
+        if adaptive and time.time() - batch_t0 < self.BATCH_TIME:
+          batch_size *= 2
 
-        # Did we reach or exceed our target?
-        if pow <= self.target:
+        for (nounce_bin, pow) in found:
           result = dict(
             job_id = self.id,
             extranounce2 = hexlify(extranounce2_bin),
-            ntime = str(self._ntime),                    # Convert to str from json unicode
-            nounce = hexlify(nounce_bin[::-1])
+            ntime = self._ntime,
+            nounce = hexlify(nounce_bin[::-1]),
+            pow = pow
           )
           self._dt += (time.time() - t0)
 
@@ -461,7 +808,8 @@ class Job(object):
 
           t0 = time.time()
 
-        self._hash_count += 1
+        self._hash_count += len(range(batch_start, batch_stop, nounce_stride))
+        batch_start = batch_stop
 
 
   def __str__(self):
@@ -476,6 +824,11 @@ class Subscription(object):
   def ProofOfWork(header):
     raise Exception('Do not use the Subscription class directly, subclass it')
 
+  # Subclasses with several implementations of ProofOfWork should override this
+  # with the most trustworthy one (used to spot-check shares)
+  def ReferenceProofOfWork(self, header):
+    return self.ProofOfWork(header)
+
   class StateException(Exception): pass
 
   def __init__(self):
@@ -523,6 +876,23 @@ class Subscription(object):
     self._set_target(target)
 
 
+  def set_target(self, target):
+    '''Sets the target directly (eg. a block target from getblocktemplate) rather than from a difficulty.'''
+
+    self._target = '%064x' % target
+
+
+  def difficulty_for_hashrate(self, hashrate, shares_per_minute):
+    '''Returns the difficulty at which hashrate would find (on average)
+       shares_per_minute shares, or None if it cannot be estimated yet.'''
+
+    if not self._difficulty or hashrate <= 0 or shares_per_minute <= 0: return None
+
+    # The expected number of hashes per share scales linearly with difficulty
+    hashes_per_share = (2 ** 256) / float(min(int(self._target, 16), 2 ** 256 - 1) + 1)
+    return self._difficulty * (hashrate * 60.0 / shares_per_minute) / hashes_per_share
+
+
   def set_subscription(self, subscription_id, extranounce1, extranounce2_size):
     if self._id is not None:
       raise self.StateException('Already subscribed')
@@ -562,16 +932,17 @@ class SubscriptionScrypt(Subscription):
   '''Subscription for Scrypt-based coins, like Litecoin.'''
 
   ProofOfWork = lambda s, h: (scrypt_proof_of_work(h))
+  ReferenceProofOfWork = lambda s, h: (scrypt(h, h, 1024, 1, 1, 32))
 
   def _set_target(self, target):
     # Why multiply by 2**16? See: https://litecoin.info/Mining_pool_comparison
-    self._target = '%064x' % (target << 16)
+    self._target = '%064x' % min(target << 16, 2 ** 256 - 1)
 
 
 class SubscriptionSHA256D(Subscription):
   '''Subscription for Double-SHA256-based coins, like Bitcoin.'''
 
-  ProofOfWork = sha256d
+  ProofOfWork = lambda s, h: (sha256d(h))
 
 
 # Maps algorithms to their respective subscription objects
@@ -607,6 +978,9 @@ class SimpleJsonRpcClient(object):
     '''Sub-classes can raise this to inform the user of JSON-RPC server issues.'''
     pass
 
+  # How many bytes to read from the socket at a time
+  RECV_SIZE = 65536
+
   def __init__(self):
     self._socket = None
     self._lock = threading.RLock()
@@ -614,39 +988,57 @@ class SimpleJsonRpcClient(object):
     self._message_id = 1
     self._requests = dict()
 
+    # When the message being handled was received and parsed (for tracing)
+    self._received_time = None
+    self._parsed_time = None
+
 
   def _handle_incoming_rpc(self):
-    data = ""
+    data = b''
     while True:
-      # Get the next line if we have one, otherwise, read and block
-      if '\n' in data:
-        (line, data) = data.split('\n', 1)
-      else:
-        chunk = self._socket.recv(1024)
-        data += chunk
-        continue
+      # Read and block, then handle every complete line we have
+      chunk = self._socket.recv(self.RECV_SIZE)
+      self._received_time = time.time()
+      if not chunk:
+        self.handle_disconnect()
+        return
 
-      log('JSON-RPC Server > ' + line, LEVEL_PROTOCOL)
+      # Split before decoding, so a chunk may end part way through a character
+      lines = (data + chunk).split(b'\n')
+      data = lines.pop()
+      for line in lines:
+        self._handle_line(line.decode('utf-8', 'replace'))
 
-      # Parse the JSON
-      try:
-        reply = json.loads(line)
-      except Exception, e:
-        log("JSON-RPC Error: Failed to parse JSON %r (skipping)" % line, LEVEL_ERROR)
-        continue
 
-      try:
-        request = None
-        with self._lock:
-          if 'id' in reply and reply['id'] in self._requests:
-            request = self._requests[reply['id']]
-          self.handle_reply(request = request, reply = reply)
-      except self.RequestReplyWarning, e:
-        output = e.message
-        if e.request:
-          output += '\n  ' + e.request
-        output += '\n  ' + e.reply
-        log(output, LEVEL_ERROR)
+  def _handle_line(self, line):
+    log('JSON-RPC Server > ' + line, LEVEL_PROTOCOL)
+
+    # Parse the JSON
+    try:
+      reply = json.loads(line)
+      self._parsed_time = time.time()
+    except Exception as e:
+      log("JSON-RPC Error: Failed to parse JSON %r (skipping)" % line, LEVEL_ERROR)
+      return
+
+    try:
+      self._dispatch(reply)
+    except self.RequestReplyWarning as e:
+      output = str(e)
+      if e.request:
+        output += '\n  ' + json.dumps(e.request)
+      if e.reply is not None:
+        output += '\n  ' + json.dumps(e.reply)
+      log(output, LEVEL_ERROR)
+
+
+  def _dispatch(self, reply):
+    with self._lock:
+      # Each request gets one reply, so we are done tracking it
+      request = None
+      if 'id' in reply:
+        request = self._requests.pop(reply['id'], None)
+      self.handle_reply(request = request, reply = reply)
 
 
   def handle_reply(self, request, reply):
@@ -654,18 +1046,31 @@ class SimpleJsonRpcClient(object):
     raise self.RequestReplyWarning('Override this method')
 
 
-  def send(self, method, params):
-    '''Sends a message to the JSON-RPC server'''
+  def handle_disconnect(self):
+    # Override this method in sub-classes to handle the server closing the connection
+    log("JSON-RPC Error: Connection closed by server", LEVEL_ERROR)
+
+
+  def send(self, method, params, message_format = None):
+    '''Sends a message to the JSON-RPC server
+
+       If message_format is given, it is used as the already encoded message with
+       the id filled in (%d), rather than encoding params again.
+    '''
 
     if not self._socket:
       raise self.ClientException('Not connected')
 
-    request = dict(id = self._message_id, method = method, params = params)
-    message = json.dumps(request)
     with self._lock:
+      request = dict(id = self._message_id, method = method, params = params)
+      if message_format:
+        message = message_format % self._message_id
+      else:
+        message = json.dumps(request)
+
       self._requests[self._message_id] = request
       self._message_id += 1
-      self._socket.send(message + '\n')
+      self._socket.sendall((message + '\n').encode('utf-8'))
 
     log('JSON-RPC Server < ' + message, LEVEL_PROTOCOL)
 
@@ -685,6 +1090,45 @@ class SimpleJsonRpcClient(object):
     self._rpc_thread.start()
 
 
+class StratumCodec(object):
+  '''Parsing and encoding of the most frequent stratum messages, mining.notify
+     from the server and mining.submit to it, with as little work as possible.'''
+
+  class CodecException(Exception): pass
+
+  @staticmethod
+  def parse_notify(params):
+    '''Validates the params of a mining.notify message, returning (job_id, prevhash,
+       coinb1, coinb2, merkle_branches, version, nbits, ntime, clean_jobs).
+
+       Hexidecimal fields must be strings.'''
+
+    if not isinstance(params, list) or len(params) != 9:
+      raise StratumCodec.CodecException('expected 9 params')
+
+    (job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, clean_jobs) = params
+
+    if not isinstance(merkle_branches, list) or [ h for h in [ prevhash, coinb1, coinb2, version, nbits, ntime ] + merkle_branches if not isinstance(h, str) ]:
+      raise StratumCodec.CodecException('expected hexidecimal strings')
+
+    if len(prevhash) != 64 or len(version) != 8 or len(nbits) != 8 or len(ntime) != 8:
+      raise StratumCodec.CodecException('wrong length for prevhash, version, nbits or ntime')
+
+    if [ b for b in merkle_branches if len(b) != 64 ]:
+      raise StratumCodec.CodecException('wrong length for merkle branch')
+
+    return (job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, bool(clean_jobs))
+
+
+  @staticmethod
+  def submit_format(worker_name, job_id):
+    '''Returns a pre-encoded mining.submit message for a job, to be filled in by
+       format % (extranounce2, ntime, nounce) and then % id (see SimpleJsonRpcClient.send).'''
+
+    encode = lambda v: json.dumps(v).replace('%', '%%%%')
+    return '{"id": %%%%d, "method": "mining.submit", "params": [%s, %s, "%%s", "%%s", "%%s"]}' % (encode(worker_name), encode(job_id))
+
+
 # Miner client
 class Miner(SimpleJsonRpcClient):
   '''Simple mining client'''
@@ -695,155 +1139,1949 @@ class Miner(SimpleJsonRpcClient):
 
   class MinerAuthenticationException(SimpleJsonRpcClient.RequestReplyException): pass
 
-  def __init__(self, url, username, password, algorithm = ALGORITHM_SCRYPT):
+  # How often (in seconds) to re-measure and possibly suggest a new difficulty
+  SUGGEST_DIFFICULTY_INTERVAL = 60
+
+  # Only suggest a difficulty which differs from the current one by this factor
+  SUGGEST_DIFFICULTY_TOLERANCE = 1.5
+
+  # How often (in seconds) serve_forever logs why shares were dropped or rejected
+  REPORT_INTERVAL = 60
+
+  def __init__(self, url, username, password, algorithm = ALGORITHM_SCRYPT, shares_per_minute = None, verify_fraction = 0.0):
     SimpleJsonRpcClient.__init__(self)
 
     self._url = url
     self._username = username
     self._password = password
 
+    self._algorithm = algorithm
     self._subscription = SubscriptionByAlgorithm[algorithm]()
 
+    # If set, suggest difficulties to the server (mining.suggest_difficulty) to aim for this
+    self._shares_per_minute = shares_per_minute
+
     self._job = None
 
+    # The jobs that shares may still be submitted for (reset by clean_jobs)
+    self._job_ids = dict()
+
+    # What fraction of shares to re-verify with the reference proof-of-work
+    self._verify_fraction = verify_fraction
+
+    # If set, the scheduler decides which threads mine our jobs
+    self._scheduler = None
+
+    # Share and hash metrics (jobs currently being mined count towards hash_count)
+    self._metrics_lock = threading.Lock()
+    self._found_shares = 0
     self._accepted_shares = 0
+    self._rejected_shares = 0
+    self._filtered_shares = dict()
+    self._rejected_reasons = dict()
+    self._hash_count = 0
+    self._hash_t0 = None
+    self._mining_jobs = [ ]
+
+    # Seconds after START_TIME that the first share was submitted
+    self._first_share_time = None
 
   # Accessors
   url = property(lambda s: s._url)
   username = property(lambda s: s._username)
   password = property(lambda s: s._password)
 
+  algorithm = property(lambda s: s._algorithm)
+  subscription = property(lambda s: s._subscription)
+  scheduler = property(lambda s: s._scheduler)
+  shares_per_minute = property(lambda s: s._shares_per_minute)
 
-  # Overridden from SimpleJsonRpcClient
-  def handle_reply(self, request, reply):
-
-    # New work, stop what we were doing before, and start on this.
-    if reply.get('method') == 'mining.notify':
-      if 'params' not in reply or len(reply['params']) != 9:
-        raise self.MinerWarning('Malformed mining.notify message', reply)
-
-      (job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, clean_jobs) = reply['params']
-      self._spawn_job_thread(job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime)
-
-      log('New job: job_id=%s' % job_id, LEVEL_DEBUG)
+  found_shares = property(lambda s: s._found_shares)
+  accepted_shares = property(lambda s: s._accepted_shares)
+  rejected_shares = property(lambda s: s._rejected_shares)
+  first_share_time = property(lambda s: s._first_share_time)
 
-    # The server wants us to change our difficulty (on all *future* work)
-    elif reply.get('method') == 'mining.set_difficulty':
-      if 'params' not in reply or len(reply['params']) != 1:
-        raise self.MinerWarning('Malformed mining.set_difficulty message', reply)
+  # Counts (by reason) of shares dropped before submitting, and rejected by the server
+  filtered_shares = property(lambda s: dict(s._filtered_shares))
+  rejected_reasons = property(lambda s: dict(s._rejected_reasons))
 
-      (difficulty, ) = reply['params']
-      self._subscription.set_difficulty(difficulty)
+  # The jobs shares may still be submitted for
+  job_ids = property(lambda s: list(s._job_ids))
 
-      log('Change difficulty: difficulty=%s' % difficulty, LEVEL_DEBUG)
 
-    # This is a reply to...
-    elif request:
+  @property
+  def hash_count(self):
+    '''The total number of hashes computed for this miner, including running jobs.'''
 
-      # ...subscribe; set-up the work and request authorization
-      if request.get('method') == 'mining.subscribe':
-        if 'result' not in reply or len(reply['result']) != 3 or len(reply['result'][0]) != 2:
-          raise self.MinerWarning('Reply to mining.subscribe is malformed', reply, request)
+    with self._metrics_lock:
+      return self._hash_count + sum(j.hash_count for j in self._mining_jobs)
 
-        ((mining_notify, subscription_id), extranounce1, extranounce2_size) = reply['result']
 
-        self._subscription.set_subscription(subscription_id, extranounce1, extranounce2_size)
+  @property
+  def hashrate(self):
+    '''The average hashrate since the first job was received.'''
 
-        log('Subscribed: subscription_id=%s' % subscription_id, LEVEL_DEBUG)
+    if self._hash_t0 is None: return 0.0
+    dt = time.time() - self._hash_t0
+    if dt <= 0: return 0.0
+    return self.hash_count / dt
 
-        # Request authentication
-        self.send(method = 'mining.authorize', params = [ self.username, self.password ])
 
-      # ...authorize; if we failed to authorize, quit
-      elif request.get('method') == 'mining.authorize':
-        if 'result' not in reply or not reply['result']:
-          raise self.MinerAuthenticationException('Failed to authenticate worker', reply, request)
+  def set_scheduler(self, scheduler):
+    '''Hands new jobs to scheduler (see MinerScheduler) instead of a dedicated thread.'''
 
-        worker_name = request['params'][0]
-        self._subscription.set_worker_name(worker_name)
+    self._scheduler = scheduler
 
-        log('Authorized: worker_name=%s' % worker_name, LEVEL_DEBUG)
 
-      # ...submit; complain if the server didn't accept our submission
-      elif request.get('method') == 'mining.submit':
-        if 'result' not in reply or not reply['result']:
-          log('Share - Invalid', LEVEL_INFO)
-          raise self.MinerWarning('Failed to accept submit', reply, request)
+  # Overridden from SimpleJsonRpcClient
+  def handle_reply(self, request, reply):
 
-        self._accepted_shares += 1
-        log('Accepted shares: %d' % self._accepted_shares, LEVEL_INFO)
+    # A message from the server...
+    method = reply.get('method')
+    if method:
+      handler = self._notification_handlers.get(method)
+      if handler is None:
+        raise self.MinerWarning('Unhandled message', reply, request)
+      handler(self, reply)
 
-      # ??? *shrug*
-      else:
+    # ...or a reply to one of our requests
+    elif request:
+      handler = self._reply_handlers.get(request.get('method'))
+      if handler is None:
         raise self.MinerWarning('Unhandled message', reply, request)
+      handler(self, request, reply)
 
     # ??? *double shrug*
     else:
       raise self.MinerWarning('Bad message state', reply)
 
 
-  def _spawn_job_thread(self, job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime):
-    '''Stops any previous job and begins a new job.'''
+  def _handle_notify(self, reply):
+    '''New work, stop what we were doing before, and start on this.'''
 
-    # Stop the old job (if any)
-    if self._job: self._job.stop()
+    try:
+      (job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, clean_jobs) = StratumCodec.parse_notify(reply.get('params'))
+    except StratumCodec.CodecException as e:
+      raise self.MinerWarning('Malformed mining.notify message (%s)' % e, reply)
 
-    # Create the new job
-    self._job = self._subscription.create_job(
-      job_id = job_id,
-      prevhash = prevhash,
-      coinb1 = coinb1,
-      coinb2 = coinb2,
-      merkle_branches = merkle_branches,
-      version = version,
-      nbits = nbits,
-      ntime = ntime
-    )
+    trace(TRACE_NOTIFY_RECEIVED, job_id, timestamp = self._received_time)
+    trace(TRACE_NOTIFY_PARSED, job_id, timestamp = self._parsed_time)
 
-    def run(job):
-      try:
-        for result in job.mine():
-          params = [ self._subscription.worker_name ] + [ result[k] for k in ('job_id', 'extranounce2', 'ntime', 'nounce') ]
-          self.send(method = 'mining.submit', params = params)
-          log("Found share: " + str(params), LEVEL_INFO)
-        log("Hashrate: %s" % human_readable_hashrate(job.hashrate), LEVEL_INFO)
-      except Exception, e:
-        log("ERROR: %s" % e, LEVEL_ERROR)
+    # Shares for older jobs are only stale if the server says so; each job
+    # maps to its mining.submit format (created with the first share)
+    if clean_jobs:
+      self._job_ids = { job_id: None }
+    else:
+      self._job_ids[job_id] = None
 
-    thread = threading.Thread(target = run, args = (self._job, ))
-    thread.daemon = True
-    thread.start()
+    self._spawn_job_thread(job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime)
 
+    log('New job: job_id=%s' % job_id, LEVEL_DEBUG)
 
-  def serve_forever(self):
-    '''Begins the miner. This method does not return.'''
 
-    # Figure out the hostname and port
-    url = urlparse.urlparse(self.url)
-    hostname = url.hostname or ''
-    port = url.port or 9333
+  def _handle_set_difficulty(self, reply):
+    '''The server wants us to change our difficulty (on all *future* work).'''
 
-    log('Starting server on %s:%d' % (hostname, port), LEVEL_INFO)
+    if 'params' not in reply or len(reply['params']) != 1:
+      raise self.MinerWarning('Malformed mining.set_difficulty message', reply)
+
+    (difficulty, ) = reply['params']
+    self._subscription.set_difficulty(difficulty)
+
+    log('Change difficulty: difficulty=%s' % difficulty, LEVEL_DEBUG)
+
+
+  def _handle_subscribe_reply(self, request, reply):
+    '''Set-up the work and request authorization.'''
+
+    if 'result' not in reply or len(reply['result']) != 3 or len(reply['result'][0]) != 2:
+      raise self.MinerWarning('Reply to mining.subscribe is malformed', reply, request)
+
+    ((mining_notify, subscription_id), extranounce1, extranounce2_size) = reply['result']
+
+    self._subscription.set_subscription(subscription_id, extranounce1, extranounce2_size)
+
+    log('Subscribed: subscription_id=%s' % subscription_id, LEVEL_DEBUG)
+
+    # Request authentication
+    self.send(method = 'mining.authorize', params = [ self.username, self.password ])
+
+
+  def _handle_authorize_reply(self, request, reply):
+    '''If we failed to authorize, quit.'''
+
+    if 'result' not in reply or not reply['result']:
+      raise self.MinerAuthenticationException('Failed to authenticate worker', reply, request)
+
+    worker_name = request['params'][0]
+    self._subscription.set_worker_name(worker_name)
+
+    log('Authorized: worker_name=%s' % worker_name, LEVEL_DEBUG)
+
+
+  def _handle_submit_reply(self, request, reply):
+    '''Complain if the server didn't accept our submission.'''
+
+    trace(TRACE_SUBMIT_REPLY, request['params'][1], request['id'])
+
+    if 'result' not in reply or not reply['result']:
+      reason = 'unknown'
+      if isinstance(reply.get('error'), list) and len(reply['error']) >= 2:
+        reason = str(reply['error'][1])
+
+      with self._metrics_lock:
+        self._rejected_shares += 1
+        self._rejected_reasons[reason] = self._rejected_reasons.get(reason, 0) + 1
+      log('Share - Invalid', LEVEL_INFO)
+      raise self.MinerWarning('Failed to accept submit', reply, request)
+
+    with self._metrics_lock:
+      self._accepted_shares += 1
+    log('Accepted shares: %d' % self._accepted_shares, LEVEL_INFO)
+
+
+  def _handle_suggest_difficulty_reply(self, request, reply):
+    '''Not all servers support it, so stop asking if it failed.'''
+
+    if reply.get('error') or reply.get('result') is False:
+      self._shares_per_minute = None
+      raise self.MinerWarning('Server does not support mining.suggest_difficulty', reply, request)
+
+
+  # Dispatch tables; messages from the server by method, and replies by the
+  # method of our request (sub-classes may extend these)
+  _notification_handlers = {
+    'mining.notify': _handle_notify,
+    'mining.set_difficulty': _handle_set_difficulty,
+  }
+
+  _reply_handlers = {
+    'mining.subscribe': _handle_subscribe_reply,
+    'mining.authorize': _handle_authorize_reply,
+    'mining.submit': _handle_submit_reply,
+    'mining.suggest_difficulty': _handle_suggest_difficulty_reply,
+  }
+
+
+  def _spawn_job_thread(self, job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime):
+    '''Stops any previous job and begins a new job.'''
+
+    # Stop the old job (if any)
+    if self._job: self._job.stop()
+
+    # Create the new job
+    self._job = self._subscription.create_job(
+      job_id = job_id,
+      prevhash = prevhash,
+      coinb1 = coinb1,
+      coinb2 = coinb2,
+      merkle_branches = merkle_branches,
+      version = version,
+      nbits = nbits,
+      ntime = ntime
+    )
+
+    trace(TRACE_JOB_CREATED, job_id)
+
+    if self._hash_t0 is None:
+      self._hash_t0 = time.time()
+      log('Time to first job: %.3fs' % (self._hash_t0 - START_TIME), LEVEL_DEBUG)
+
+    # Let the scheduler share its worker threads out
+    if self._scheduler:
+      self._scheduler.set_job(self, self._job)
+      return
+
+    def run(job):
+      try:
+        self.mine_job(job)
+        log("Hashrate: %s" % human_readable_hashrate(job.hashrate), LEVEL_INFO)
+      except Exception as e:
+        log("ERROR: %s" % e, LEVEL_ERROR)
+
+    thread = threading.Thread(target = run, args = (self._job, ))
+    thread.daemon = True
+    thread.start()
+
+
+  def mine_job(self, job, nounce_start = 0, nounce_stride = 1, extranounce2_start = 0, throttle = None, batch_size = None, search = None):
+    '''Mines job (see Job.mine), submitting every share found, until the job is stopped.'''
+
+    with self._metrics_lock:
+      self._mining_jobs.append(job)
+
+    try:
+      for result in job.mine(nounce_start = nounce_start, nounce_stride = nounce_stride, extranounce2_start = extranounce2_start, throttle = throttle, batch_size = batch_size, search = search):
+        self.submit(result, job)
+    finally:
+      with self._metrics_lock:
+        self._mining_jobs.remove(job)
+        self._hash_count += job.hash_count
+
+
+  def filter_share(self, result, job = None):
+    '''Returns the reason (SHARE_*) the server would reject a share (a result from
+       Job.mine), or None if it looks good.
+
+       If job is given, a fraction (verify_fraction) of shares are re-verified with
+       the reference proof-of-work.
+    '''
+
+    if result['job_id'] not in self._job_ids:
+      return SHARE_STALE
+
+    if 'pow' in result and result['pow'] > self._subscription.target:
+      return SHARE_LOW_DIFFICULTY
+
+    if job and self._verify_fraction and random.random() < self._verify_fraction:
+      if job.verify(result, self._subscription.ReferenceProofOfWork) != result['pow']:
+        log('Share failed verification with the reference proof-of-work: %r' % result, LEVEL_ERROR)
+        return SHARE_INVALID
+
+    return None
+
+
+  def submit(self, result, job = None):
+    '''Submits a share (a result from Job.mine) to the server, unless filter_share
+       rejects it. Returns whether the share was submitted.'''
+
+    return self.submit_share(result, job) is None
+
+
+  def submit_share(self, result, job = None):
+    '''As submit, but returns the reason (SHARE_*) filter_share dropped the share
+       for, or None if it was submitted.'''
+
+    found_time = time.time()
+
+    reason = self.filter_share(result, job)
+    if reason:
+      with self._metrics_lock:
+        self._filtered_shares[reason] = self._filtered_shares.get(reason, 0) + 1
+      log('Dropped share (%s): job_id=%s' % (reason, result['job_id']), LEVEL_DEBUG)
+      return reason
+
+    self._send_share(result, job, found_time)
+
+    with self._metrics_lock:
+      self._found_shares += 1
+      first_share = (self._first_share_time is None)
+      if first_share: self._first_share_time = time.time() - START_TIME
+
+    if first_share:
+      log('Time to first share: %.3fs' % self._first_share_time, LEVEL_INFO)
+
+    return None
+
+
+  def _send_share(self, result, job, found_time):
+    '''Sends a share which passed filter_share to the server (sub-classes which
+       speak another protocol override this).'''
+
+    params = [ self._subscription.worker_name ] + [ result[k] for k in ('job_id', 'extranounce2', 'ntime', 'nounce') ]
+
+    # Only the changing parts of the message need encoding; the format is only
+    # cached if the job is still valid (a clean_jobs notify replaces job_ids)
+    job_ids = self._job_ids
+    submit_format = job_ids.get(result['job_id'])
+    if submit_format is None:
+      submit_format = StratumCodec.submit_format(self._subscription.worker_name, result['job_id'])
+      if result['job_id'] in job_ids: job_ids[result['job_id']] = submit_format
+    message_format = submit_format % (result['extranounce2'], result['ntime'], result['nounce'])
+
+    # Hold the lock so the reply cannot be handled before the traces are written
+    with self._lock:
+      request = self.send(method = 'mining.submit', params = params, message_format = message_format)
+
+      trace(TRACE_SHARE_FOUND, result['job_id'], request['id'], timestamp = found_time)
+      trace(TRACE_SUBMIT_WRITTEN, result['job_id'], request['id'])
+
+    log("Found share: " + str(params), LEVEL_INFO)
+
+
+  def _adjust_difficulty(self):
+    '''Periodically measures the hashrate and found-share rate, suggesting a new
+       difficulty to the server when we are far from shares_per_minute.'''
+
+    (t0, hash_count, found_shares) = (time.time(), self.hash_count, self._found_shares)
+
+    while self._shares_per_minute:
+      time.sleep(self.SUGGEST_DIFFICULTY_INTERVAL)
+
+      now = time.time()
+      dt = now - t0
+      hashrate = (self.hash_count - hash_count) / dt
+      share_rate = (self._found_shares - found_shares) * 60.0 / dt
+      (t0, hash_count, found_shares) = (now, self.hash_count, self._found_shares)
+
+      log('Measured hashrate=%s shares/min=%.2f (target shares/min=%s)' % (human_readable_hashrate(hashrate), share_rate, self._shares_per_minute), LEVEL_DEBUG)
+
+      current = self._subscription.difficulty
+      difficulty = self._subscription.difficulty_for_hashrate(hashrate, self._shares_per_minute or 0)
+      if not difficulty: continue
+
+      # Close enough; don't make the server (or us) churn targets
+      if current and 1.0 / self.SUGGEST_DIFFICULTY_TOLERANCE < difficulty / current < self.SUGGEST_DIFFICULTY_TOLERANCE:
+        continue
+
+      difficulty = float('%.4g' % difficulty)
+      log('Suggesting difficulty: difficulty=%s' % difficulty, LEVEL_DEBUG)
+      try:
+        self.send(method = 'mining.suggest_difficulty', params = [ difficulty ])
+      except Exception as e:
+        log("ERROR: %s" % e, LEVEL_ERROR)
+
+
+  def start(self):
+    '''Connects to the server and subscribes; work is then handled in the background.'''
+
+    # Figure out the hostname and port
+    url = urllib.parse.urlparse(self.url)
+    hostname = url.hostname or ''
+    port = url.port or 9333
+
+    log('Starting server on %s:%d' % (hostname, port), LEVEL_INFO)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((hostname, port))
+    self.connect(sock)
+
+    self.send(method = 'mining.subscribe', params = [ "%s/%s" % (USER_AGENT, '.'.join(str(p) for p in VERSION)) ])
+
+    if self._shares_per_minute:
+      thread = threading.Thread(target = self._adjust_difficulty)
+      thread.daemon = True
+      thread.start()
+
+
+  def log_share_reasons(self):
+    '''Logs how many shares were dropped (see filter_share) or rejected by the
+       server, by reason, if there were any.'''
+
+    reasons = [ ('dropped %s' % r, c) for (r, c) in self.filtered_shares.items() ] + [ ('rejected %r' % r, c) for (r, c) in self.rejected_reasons.items() ]
+    if reasons:
+      log('Pool %s: %s' % (self.url, ', '.join('%s=%d' % rc for rc in sorted(reasons))), LEVEL_INFO)
+
+
+  def serve_forever(self):
+    '''Begins the miner. This method does not return.'''
+
+    self.start()
+
+    # Forever...
+    while True:
+      time.sleep(self.REPORT_INTERVAL)
+      self.log_share_reasons()
+
+
+# Helpers for building blocks ourselves (see GetBlockTemplateMiner)
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+# Address versions (bitcoin, bitcoin testnet, litecoin, litecoin testnet) which are pay-to-script-hash
+P2SH_ADDRESS_VERSIONS = [ 5, 196, 50, 58 ]
+
+
+def base58check_decode(address):
+  '''Decodes a base58check string (eg. an address), returning (version, payload).'''
+
+  value = 0
+  for c in address:
+    index = BASE58_ALPHABET.find(c)
+    if index < 0: raise ValueError('Invalid base58 character %r' % c)
+    value = value * 58 + index
+
+  data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+
+  # Leading 1s are leading zero bytes
+  data = b'\0' * (len(address) - len(address.lstrip('1'))) + data
+
+  if len(data) < 5 or sha256d(data[:-4])[:4] != data[-4:]:
+    raise ValueError('Invalid base58check checksum')
+
+  return (data[0], data[1:-4])
+
+
+def address_to_script(address):
+  '''Returns the binary output script paying to a base58 address.'''
+
+  (version, payload) = base58check_decode(address)
+  if len(payload) != 20: raise ValueError('Unsupported address %r' % address)
+
+  # OP_HASH160 <hash> OP_EQUAL
+  if version in P2SH_ADDRESS_VERSIONS:
+    return b'\xa9\x14' + payload + b'\x87'
+
+  # OP_DUP OP_HASH160 <hash> OP_EQUALVERIFY OP_CHECKSIG
+  return b'\x76\xa9\x14' + payload + b'\x88\xac'
+
+
+def serialize_varint(value):
+  '''Serializes a variable length integer (as used for lengths and counts in transactions and blocks).'''
+
+  if value < 0xfd: return struct.pack('<B', value)
+  if value <= 0xffff: return b'\xfd' + struct.pack('<H', value)
+  if value <= 0xffffffff: return b'\xfe' + struct.pack('<I', value)
+  return b'\xff' + struct.pack('<Q', value)
+
+
+def serialize_script_number(value):
+  '''Serializes a push of a (non-negative) number in a script, as for the block height (BIP 34).'''
+
+  if value == 0: return b'\x00'
+  if value <= 16: return struct.pack('<B', 0x50 + value)
+
+  data = value.to_bytes((value.bit_length() + 7) // 8, 'little')
+
+  # Keep the number positive
+  if data[-1] & 0x80: data += b'\x00'
+
+  return struct.pack('<B', len(data)) + data
+
+
+def merkle_branches(hashes):
+  '''Returns the merkle branches (binary) needed to compute the merkle root from
+     the coinbase hash, given the (binary, internal byte order) hashes of every
+     other transaction.'''
+
+  branches = [ ]
+
+  # The coinbase (None) is always the left-most leaf
+  level = [ None ] + hashes
+  while len(level) > 1:
+    branches.append(level[1])
+    if len(level) % 2: level.append(level[-1])
+    level = [ None ] + [ sha256d(level[i] + level[i + 1]) for i in range(2, len(level), 2) ]
+
+  return branches
+
+
+class GetBlockTemplateMiner(Miner):
+  '''Solo mining client, getting work from a node with getblocktemplate (BIP 22/23).
+
+     Jobs are built straight from the template (the coinbase paying to
+     payout_address, merkle branches, version, nbits, ntime), new blocks are
+     noticed with longpoll and solved blocks are sent with submitblock.
+
+     The url is the node's JSON-RPC url (eg. http://127.0.0.1:8332), with username
+     and password its rpcuser and rpcpassword.
+  '''
+
+  # How long (in seconds) to wait between polls, if the node does not support longpoll
+  POLL_INTERVAL = 5
+
+  # How long (in seconds) to wait for a longpoll before asking again
+  LONGPOLL_TIMEOUT = 600
+
+  # How long (in seconds) to wait for any other request to the node
+  REQUEST_TIMEOUT = 30
+
+  # The extranounce is 4 bytes, in the coinbase script
+  EXTRANOUNCE2_SIZE = 4
+
+  # The getblocktemplate request (BIP 22/23, with segwit)
+  TEMPLATE_REQUEST = dict(rules = [ 'segwit' ], capabilities = [ 'coinbasetxn', 'workid', 'longpoll' ])
+
+  class GetBlockTemplateException(Exception): pass
+
+  def __init__(self, url, username, password, algorithm = ALGORITHM_SCRYPT, payout_address = None, verify_fraction = 0.0):
+    Miner.__init__(self, url, username, password, algorithm = algorithm, verify_fraction = verify_fraction)
+
+    if not payout_address:
+      raise self.GetBlockTemplateException('Solo mining requires a payout address')
+
+    self._payout_script = address_to_script(payout_address)
+
+    # Each job's template, by job_id (pruned along with the job ids on a new block)
+    self._templates = dict()
+    self._job_counter = 0
+    self._prevhash = None
+
+    # The longpollid of the template being mined (so it is not restarted for nothing)
+    self._longpoll_id = None
+
+    self._request_id = 0
+
+  payout_script = property(lambda s: hexlify(s._payout_script))
+
+
+  def call(self, method, params, timeout = None, url = None):
+    '''Calls a JSON-RPC method on the node, returning the result.'''
+
+    self._request_id += 1
+    request = json.dumps(dict(id = self._request_id, method = method, params = params))
+    log('JSON-RPC Server < ' + request, LEVEL_PROTOCOL)
+
+    http_request = urllib.request.Request(url or self.url, request.encode('utf-8'), { 'Content-Type': 'application/json' })
+    if self.username or self.password:
+      http_request.add_header('Authorization', 'Basic ' + base64.b64encode(('%s:%s' % (self.username, self.password)).encode('utf-8')).decode('ascii'))
+
+    try:
+      response = urllib.request.urlopen(http_request, timeout = timeout or self.REQUEST_TIMEOUT).read()
+    except urllib.error.HTTPError as e:
+      # bitcoind replies to failed calls with an HTTP error, but a JSON-RPC body
+      response = e.read()
+
+    response = response.decode('utf-8')
+
+    log('JSON-RPC Server > ' + response.strip(), LEVEL_PROTOCOL)
+
+    reply = json.loads(response)
+    if reply.get('error'):
+      raise self.GetBlockTemplateException('%s failed: %r' % (method, reply['error']))
+
+    return reply['result']
+
+
+  def _handle_template(self, template):
+    '''Builds a Job from a block template and starts mining it. Must be called
+       with the lock held.'''
+
+    # Both a longpoll and a fetch (see _send_share) may bring the same template
+    if template.get('longpollid') is not None and template.get('longpollid') == self._longpoll_id:
+      return
+
+    self._longpoll_id = template.get('longpollid')
+
+    self._job_counter += 1
+    job_id = '%x' % self._job_counter
+
+    # The coinbase script: the block height (BIP 34), the extranounce2 and a tag
+    script_prefix = serialize_script_number(template['height']) + struct.pack('<B', self.EXTRANOUNCE2_SIZE)
+    script_suffix = unhexlify(template.get('coinbaseaux', { }).get('flags', ''))
+    script_suffix += struct.pack('<B', len(USER_AGENT)) + USER_AGENT.encode('ascii')
+    script_length = len(script_prefix) + self.EXTRANOUNCE2_SIZE + len(script_suffix)
+
+    outputs = [ struct.pack('<Q', template['coinbasevalue']) + serialize_varint(len(self._payout_script)) + self._payout_script ]
+    if template.get('default_witness_commitment'):
+      commitment = unhexlify(template['default_witness_commitment'])
+      outputs.append(struct.pack('<Q', 0) + serialize_varint(len(commitment)) + commitment)
+
+    # The coinbase transaction, split around the extranounce2
+    coinb1 = struct.pack('<I', 1) + serialize_varint(1) + (b'\0' * 32) + b'\xff\xff\xff\xff' + serialize_varint(script_length) + script_prefix
+    coinb2 = script_suffix + b'\xff\xff\xff\xff' + serialize_varint(len(outputs)) + b''.join(outputs) + struct.pack('<I', 0)
+
+    # Hashes are given big-endian (as displayed); we need them as they are hashed
+    hashes = [ unhexlify(t.get('txid', t.get('hash')))[::-1] for t in template['transactions'] ]
+    branches = [ hexlify(b) for b in merkle_branches(hashes) ]
+
+    # The header swaps the endianness of each word of the stratum prevhash
+    prevhash = hexlify(swap_endian_words(hexlify(unhexlify(template['previousblockhash'])[::-1])))
+
+    # A new block means the old jobs are stale
+    clean_jobs = (template['previousblockhash'] != self._prevhash)
+    self._prevhash = template['previousblockhash']
+    if clean_jobs:
+      self._job_ids = { job_id: None }
+      self._templates = dict()
+    else:
+      self._job_ids[job_id] = None
+    self._templates[job_id] = template
+
+    self._subscription.set_target(int(template['target'], 16))
+
+    self._spawn_job_thread(job_id, prevhash, hexlify(coinb1), hexlify(coinb2), branches, '%08x' % template['version'], str(template['bits']), '%08x' % template['curtime'])
+
+    log('New job: job_id=%s height=%d transactions=%d' % (job_id, template['height'], len(template['transactions'])), LEVEL_DEBUG)
+
+
+  def _fetch_template(self):
+    '''Fetches a block template now (without waiting on longpoll) and starts mining it.'''
+
+    template = self.call('getblocktemplate', [ dict(self.TEMPLATE_REQUEST) ])
+    with self._lock:
+      self._handle_template(template)
+
+
+  def _poll_templates(self):
+    '''Fetches block templates forever, using longpoll if the node supports it.'''
+
+    longpoll_id = None
+    longpoll_url = None
+    while True:
+      try:
+        params = dict(self.TEMPLATE_REQUEST)
+        if longpoll_id:
+          params['longpollid'] = longpoll_id
+          template = self.call('getblocktemplate', [ params ], timeout = self.LONGPOLL_TIMEOUT, url = longpoll_url)
+        else:
+          template = self.call('getblocktemplate', [ params ])
+
+      except socket.timeout as e:
+        continue
+
+      except Exception as e:
+        log('ERROR: getblocktemplate failed (%s)' % e, LEVEL_ERROR)
+        longpoll_id = None
+        time.sleep(self.POLL_INTERVAL)
+        continue
+
+      # Only restart work if something changed
+      with self._lock:
+        self._handle_template(template)
+
+      longpoll_id = template.get('longpollid')
+      if longpoll_id:
+        longpoll_url = urllib.parse.urljoin(self.url, template.get('longpolluri', ''))
+      else:
+        time.sleep(self.POLL_INTERVAL)
+
+
+  def start(self):
+    '''Starts fetching block templates in the background.'''
+
+    log('Solo mining with %s' % self.url, LEVEL_INFO)
+
+    self._subscription.set_subscription('getblocktemplate', '', self.EXTRANOUNCE2_SIZE)
+    self._subscription.set_worker_name(self.username or USER_AGENT)
+
+    thread = threading.Thread(target = self._poll_templates)
+    thread.daemon = True
+    thread.start()
+
+
+  def serialize_block(self, result, job):
+    '''Returns the serialized (binary) block for a result from Job.mine.'''
+
+    template = self._templates[result['job_id']]
+
+    header = job.header_prefix_bin(unhexlify(result['extranounce2'])) + unhexlify(result['nounce'])[::-1]
+
+    coinbase = unhexlify(job.coinb1) + unhexlify(result['extranounce2']) + unhexlify(job.coinb2)
+
+    # With a witness commitment, the coinbase must carry the (all zero) witness reserved value
+    if template.get('default_witness_commitment'):
+      coinbase = coinbase[:4] + b'\x00\x01' + coinbase[4:-4] + b'\x01\x20' + (b'\0' * 32) + coinbase[-4:]
+
+    transactions = [ coinbase ] + [ unhexlify(t['data']) for t in template['transactions'] ]
+    return header + serialize_varint(len(transactions)) + b''.join(transactions)
+
+
+  def _send_share(self, result, job, found_time):
+    '''Submits a solved block to the node.'''
+
+    trace(TRACE_SHARE_FOUND, result['job_id'], result['nounce'], timestamp = found_time)
+
+    # The job may be stale since filter_share (eg. another thread found the block)
+    template = self._templates.get(result['job_id'])
+    if template is None or result['job_id'] not in self._job_ids:
+      with self._metrics_lock:
+        self._filtered_shares[SHARE_STALE] = self._filtered_shares.get(SHARE_STALE, 0) + 1
+      log('Dropped share (%s): job_id=%s' % (SHARE_STALE, result['job_id']), LEVEL_DEBUG)
+      return
+
+    block = hexlify(self.serialize_block(result, job))
+    log('Found block: job_id=%s nounce=%s' % (result['job_id'], result['nounce']), LEVEL_INFO)
+
+    # If the template had a workid (BIP 22), the node wants it back
+    params = [ block ]
+    workid = template.get('workid')
+    if workid is not None:
+      params.append(dict(workid = workid))
+
+    try:
+      reply = self.call('submitblock', params)
+    except Exception as e:
+      reply = str(e)
+
+    trace(TRACE_SUBMIT_REPLY, result['job_id'], result['nounce'])
+
+    # submitblock replies with null on success, otherwise the reason
+    if reply is None:
+      with self._metrics_lock:
+        self._accepted_shares += 1
+      log('Accepted blocks: %d' % self._accepted_shares, LEVEL_INFO)
+
+      # Our block is the node's new tip, so every job on its previous block is
+      # spent; drop their shares and start on the next block without waiting
+      with self._lock:
+        for (job_id, job_template) in list(self._templates.items()):
+          if job_template['previousblockhash'] == template['previousblockhash']:
+            self._job_ids.pop(job_id, None)
+      job.stop()
+
+      try:
+        self._fetch_template()
+      except Exception as e:
+        log('ERROR: getblocktemplate failed (%s)' % e, LEVEL_ERROR)
+    else:
+      with self._metrics_lock:
+        self._rejected_shares += 1
+        self._rejected_reasons[str(reply)] = self._rejected_reasons.get(str(reply), 0) + 1
+      log('Block rejected: %s' % reply, LEVEL_ERROR)
+
+
+class MinerScheduler(object):
+  '''Runs several Miner connections in one process, sharing a single pool of
+     worker threads between them in proportion to their weights.
+
+     Each Miner keeps its own Subscription (target, extranounce, etc) and job; the
+     scheduler only decides which worker threads mine which Miner's current job.
+     Miners without a job (yet) lend their share of the workers to the others.
+
+     To use this class:
+       scheduler = MinerScheduler(workers = 4)
+       scheduler.add_miner(Miner(url1, username1, password1), weight = 3)
+       scheduler.add_miner(Miner(url2, username2, password2, ALGORITHM_SHA256D), weight = 1)
+       scheduler.serve_forever()
+  '''
+
+  class SchedulerException(Exception): pass
+
+  def __init__(self, workers = 1, report_interval = 60, cpus = None, nice = None, idle = False, duty_cycle = None, processes = False, batch_size = None):
+    '''Worker threads are pinned round-robin to cpus (if given), run with the
+       given priority (see set_thread_priority) and are each throttled to
+       duty_cycle (if given) of a CPU.
+
+       If processes, each worker thread hands its hashing to a worker process
+       (see ProcessHasher), batch_size nounces at a time (see Job.mine); the
+       processes are then the ones pinned to cpus and given the priority.'''
+
+    if workers < 1:
+      raise self.SchedulerException('Must have at least one worker')
+
+    self._workers = workers
+    self._report_interval = report_interval
+
+    self._cpus = list(cpus or [ ])
+    self._nice = nice
+    self._idle = idle
+    self._duty_cycle = duty_cycle
+
+    self._processes = processes
+    self._batch_size = batch_size
+    self._hasher = None
+
+    self._condition = threading.Condition()
+    self._threads = [ ]
+
+    # [ (miner, weight), ... ]
+    self._miners = [ ]
+
+    # Per miner: (job, worker count, extranounce2_start) that its workers are mining
+    self._allocations = dict()
+
+    # Per worker thread: (miner, job, nounce_start, nounce_stride, extranounce2_start) or None,
+    # and the copy of job the worker is actually mining (so it can be stopped on its own)
+    self._tasks = [ None ] * workers
+    self._job_copies = [ None ] * workers
+
+  # Accessors
+  workers = property(lambda s: s._workers)
+  miners = property(lambda s: [ m for (m, w) in s._miners ])
+
+
+  def add_miner(self, miner, weight = 1):
+    '''Adds a miner, which receives weight / total_weight of the workers.'''
+
+    if weight <= 0:
+      raise self.SchedulerException('Weight must be positive')
+
+    with self._condition:
+      self._miners.append((miner, weight))
+      miner.set_scheduler(self)
+
+
+  def set_job(self, miner, job):
+    '''Called by a miner when it has new work; reassigns workers as required.'''
+
+    with self._condition:
+      self._allocations[miner] = (job, 0, 0)
+      self._rebalance()
+
+
+  def _worker_counts(self):
+    '''Splits the workers between miners with work, by weight (largest remainder).'''
+
+    active = [ (m, w) for (m, w) in self._miners if self._allocations.get(m, (None, ))[0] ]
+    if not active: return dict()
+
+    total_weight = float(sum(w for (m, w) in active))
+    quotas = [ (m, self._workers * w / total_weight) for (m, w) in active ]
+
+    counts = dict((m, int(q)) for (m, q) in quotas)
+    remaining = self._workers - sum(counts.values())
+    for (m, q) in sorted(quotas, key = lambda mq: mq[1] - int(mq[1]), reverse = True)[:remaining]:
+      counts[m] += 1
+
+    return counts
+
+
+  def _rebalance(self):
+    '''Recomputes which worker mines what. Must be called with the condition held.'''
+
+    counts = self._worker_counts()
+
+    # The tasks we want running; a miner whose worker count changes restarts at a
+    # fresh extranounce2 so the new stride never repeats hashes already done
+    tasks = [ ]
+    for (miner, weight) in self._miners:
+      (job, count, extranounce2_start) = self._allocations.get(miner, (None, 0, 0))
+      desired = counts.get(miner, 0)
+
+      if job and desired != count:
+        if count: extranounce2_start += 1
+        self._allocations[miner] = (job, desired, extranounce2_start)
+
+      for i in range(0, desired):
+        tasks.append((miner, job, i, desired, extranounce2_start))
+
+    # Keep any worker already doing a wanted task; stop the rest
+    free = [ ]
+    for (index, task) in enumerate(self._tasks):
+      if task in tasks:
+        tasks.remove(task)
+        continue
+
+      if self._job_copies[index]: self._job_copies[index].stop()
+      free.append(index)
+
+    # Hand the remaining tasks to the free workers
+    for index in free:
+      task = None
+      job_copy = None
+      if tasks:
+        task = tasks.pop(0)
+        job_copy = task[1].copy()
+      self._tasks[index] = task
+      self._job_copies[index] = job_copy
+
+    self._condition.notify_all()
+
+
+  def _work(self, index):
+    '''Worker thread; mines whatever task it is assigned, forever.'''
+
+    try:
+      if self._cpus: set_thread_affinity([ self._cpus[index % len(self._cpus)] ])
+      set_thread_priority(nice = self._nice, idle = self._idle)
+    except Exception as e:
+      log("ERROR: Could not set worker scheduling (%s)" % e, LEVEL_ERROR)
+
+    throttle = None
+    if self._duty_cycle: throttle = DutyCycle(self._duty_cycle)
+
+    last_job = None
+    while True:
+      with self._condition:
+        while self._job_copies[index] is None or self._job_copies[index] is last_job:
+          self._condition.wait()
+        (miner, source, nounce_start, nounce_stride, extranounce2_start) = self._tasks[index]
+        job = self._job_copies[index]
+
+      search = None
+      if self._hasher: search = self._hasher.searcher(miner.algorithm)
+
+      try:
+        miner.mine_job(job, nounce_start = nounce_start, nounce_stride = nounce_stride, extranounce2_start = extranounce2_start, throttle = throttle, batch_size = self._batch_size, search = search)
+      except Exception as e:
+        log("ERROR: %s" % e, LEVEL_ERROR)
+
+      last_job = job
+
+
+  def start(self):
+    '''Starts the worker threads and connects every miner.'''
+
+    # Fork the worker processes before starting our own threads
+    if self._processes:
+      self._hasher = ProcessHasher(self._workers, cpus = self._cpus, nice = self._nice, idle = self._idle)
+
+    for index in range(0, self._workers):
+      thread = threading.Thread(target = self._work, args = (index, ))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+    for (miner, weight) in self._miners:
+      miner.start()
+
+
+  def log_stats(self):
+    '''Logs the hashrate and share counts for each miner.'''
+
+    for (miner, weight) in self._miners:
+      (job, count, extranounce2_start) = self._allocations.get(miner, (None, 0, 0))
+      log('Pool %s: workers=%d hashrate=%s shares found=%d accepted=%d rejected=%d' % (miner.url, count, human_readable_hashrate(miner.hashrate), miner.found_shares, miner.accepted_shares, miner.rejected_shares), LEVEL_INFO)
+      miner.log_share_reasons()
+
+
+  def serve_forever(self):
+    '''Begins mining for every miner. This method does not return.'''
+
+    self.start()
+
+    # Forever...
+    while True:
+      time.sleep(self._report_interval)
+      self.log_stats()
+
+
+class SimpleJsonRpcConnection(SimpleJsonRpcClient):
+  '''The server side of a JSON-RPC connection (eg. a downstream miner).
+
+    To use this class:
+      1) Create a sub-class
+      2) Override handle_reply(self, request, reply); each incoming message is a
+         request (with request None), answered with reply(message_id, result, error)
+      3) Call connect(socket)
+
+    The server's remove_connection(connection) is called once the connection closes.
+  '''
+
+  def __init__(self, server, address):
+    SimpleJsonRpcClient.__init__(self)
+
+    self._server = server
+    self._address = address
+
+    # Only guards writes; requests are handled without it (see _dispatch)
+    self._write_lock = threading.Lock()
+
+  # Accessors
+  address = property(lambda s: s._address)
+
+
+  def _handle_incoming_rpc(self):
+    try:
+      SimpleJsonRpcClient._handle_incoming_rpc(self)
+    except socket.error as e:
+      log('JSON-RPC Error: Connection error from %s:%d (%s)' % (self._address + (e, )), LEVEL_DEBUG)
+    finally:
+      self._server.remove_connection(self)
+
+
+  def handle_disconnect(self):
+    # Clients come and go; the server logs it in remove_connection
+    pass
+
+
+  def _dispatch(self, reply):
+    # Only our reader thread handles requests, so no lock is needed; holding one
+    # would deadlock against a server sending to us while holding its own lock
+    if not isinstance(reply, dict):
+      log('JSON-RPC Error: Malformed message from %s:%d (%r)' % (self._address + (reply, )), LEVEL_DEBUG)
+      self.close()
+      return
+
+    self.handle_reply(request = None, reply = reply)
+
+
+  def send_line(self, line):
+    '''Sends an already encoded message (eg. a notification), dropping the connection on error.'''
+
+    try:
+      with self._write_lock:
+        self._socket.sendall((line + '\n').encode('utf-8'))
+      log('JSON-RPC Client %s:%d < %s' % (self._address + (line, )), LEVEL_PROTOCOL)
+    except socket.error as e:
+      self.close()
+
+
+  def notify(self, method, params):
+    self.send_line(json.dumps(dict(id = None, method = method, params = params)))
+
+
+  def close(self):
+    '''Closes the connection; the reader thread then ends (and the server's
+       remove_connection is called).'''
+
+    try:
+      self._socket.shutdown(socket.SHUT_RDWR)
+    except socket.error as e:
+      pass
+
+
+  def reply(self, message_id, result, error = None):
+    self.send_line(json.dumps(dict(id = message_id, result = result, error = error)))
+
+
+class StratumProxyConnection(SimpleJsonRpcConnection):
+  '''A downstream miner connected to a StratumProxy; its requests are handled by
+     the proxy, which replies (and sends notifications) over this connection.'''
+
+  def __init__(self, proxy, address):
+    SimpleJsonRpcConnection.__init__(self, proxy, address)
+
+    self._proxy = proxy
+
+    # Assigned on mining.subscribe; the leading bytes of every upstream extranounce2
+    self._prefix = None
+
+    self._worker_name = None
+    self._difficulty = None
+
+    # The sequence number (see StratumProxy.set_job) of the last job sent, so an
+    # older job sent from another thread cannot overtake it
+    self._job_lock = threading.Lock()
+    self._job_sequence = 0
+
+    self._accepted_shares = 0
+    self._rejected_shares = 0
+
+  # Accessors
+  prefix = property(lambda s: s._prefix)
+  worker_name = property(lambda s: s._worker_name)
+  accepted_shares = property(lambda s: s._accepted_shares)
+  rejected_shares = property(lambda s: s._rejected_shares)
+
+
+  def set_difficulty(self, difficulty):
+    '''Sends mining.set_difficulty if the difficulty has changed.'''
+
+    if difficulty is None or difficulty == self._difficulty: return
+    self._difficulty = difficulty
+    self.notify('mining.set_difficulty', [ difficulty ])
+
+
+  def send_job(self, sequence, difficulty, line):
+    '''Sends the difficulty and an encoded mining.notify, unless a job at least
+       as new (by sequence) has already been sent.'''
+
+    with self._job_lock:
+      if sequence <= self._job_sequence: return
+      self._job_sequence = sequence
+      self.set_difficulty(difficulty)
+      self.send_line(line)
+
+
+  # Overridden from SimpleJsonRpcClient; these are requests from the downstream miner
+  def handle_reply(self, request, reply):
+    try:
+      self._handle_request(reply)
+    except StratumProxy.ProxyException as e:
+      log('Proxy: Refused %s:%d (%s)' % (self._address + (e, )), LEVEL_ERROR)
+      self.reply(reply.get('id'), None, [ 20, str(e), None ])
+      self.close()
+    except Exception as e:
+      log('Proxy: Bad request from %s:%d (%s: %s)' % (self._address + (e.__class__.__name__, e)), LEVEL_ERROR)
+      self.reply(reply.get('id'), None, [ 20, 'Bad request', None ])
+      self.close()
+
+
+  def _handle_request(self, reply):
+    method = reply.get('method')
+    params = reply.get('params') or [ ]
+    message_id = reply.get('id')
+
+    if method == 'mining.subscribe':
+      if self._prefix is not None:
+        self.reply(message_id, None, [ 20, 'Already subscribed', None ])
+        return
+
+      # No job may be sent (see send_job) before the reply
+      with self._job_lock:
+        (self._prefix, extranounce1, extranounce2_size) = self._proxy.subscribe(self)
+        self.reply(message_id, [ [ 'mining.notify', hexlify(self._prefix) ], extranounce1, extranounce2_size ])
+      self._proxy.send_job(self)
+
+    elif method == 'mining.authorize':
+      # Downstream miners are trusted; every share is submitted as the proxy's worker
+      self._worker_name = params[0] if params else None
+      self.reply(message_id, True)
+
+    elif method == 'mining.submit':
+      error = self._proxy.submit(self, params)
+      if error:
+        self._rejected_shares += 1
+        self.reply(message_id, None, error)
+      else:
+        self._accepted_shares += 1
+        self.reply(message_id, True)
+
+    elif message_id is not None:
+      self.reply(message_id, None, [ 20, 'Unsupported method %s' % method, None ])
+
+
+class StratumProxy(object):
+  '''Serves stratum to many local (downstream) miners over a single upstream
+     Miner connection.
+
+     Each downstream miner is given a disjoint part of the upstream extranounce2
+     space: its extranounce1 is the upstream extranounce1 followed by a unique
+     prefix, leaving it the rest of extranounce2. Notifies are encoded once and
+     fanned out to every downstream miner; shares are checked against the job
+     locally before being submitted upstream.
+
+     To use this class:
+       proxy = StratumProxy(Miner(url, username, password), port = 3333)
+       proxy.serve_forever()
+  '''
+
+  class ProxyException(Exception): pass
+
+  # Bytes of extranounce2 to reserve for the downstream prefix (at most; the
+  # downstream miners must be left at least one byte)
+  PREFIX_SIZE = 2
+
+  def __init__(self, miner, host = '', port = 3333):
+    self._miner = miner
+    self._host = host
+    self._port = port
+
+    self._lock = threading.RLock()
+
+    # The connections, by prefix
+    self._connections = dict()
+
+    # Jobs shares may still be submitted for (by job_id), and the current
+    # mining.notify params (encoded), set on the first job from upstream; each
+    # job is numbered, so connections never go back to an older one
+    self._jobs = dict()
+    self._job_ready = threading.Event()
+    self._notify_params = None
+    self._job_sequence = 0
+
+    # Taken as the first job arrives (after upstream subscribe)
+    self._prefix_size = None
+
+    miner.set_scheduler(self)
+
+  # Accessors
+  miner = property(lambda s: s._miner)
+  connections = property(lambda s: list(s._connections.values()))
+
+
+  def subscribe(self, connection):
+    '''Assigns a connection its extranounce2 prefix, returning (prefix, extranounce1, extranounce2_size).'''
+
+    # We cannot divide the extranounce2 space until upstream tells us its size
+    self._job_ready.wait()
+
+    with self._lock:
+      if self._prefix_size < 1:
+        raise self.ProxyException('Upstream extranounce2 is too small to share')
+
+      prefix = None
+      for index in range(256 ** self._prefix_size):
+        candidate = struct.pack('>Q', index)[-self._prefix_size:]
+        if candidate not in self._connections:
+          prefix = candidate
+          break
+
+      if prefix is None:
+        raise self.ProxyException('No extranounce2 prefixes left')
+
+      self._connections[prefix] = connection
+      job = next(iter(self._jobs.values()))
+
+    log('Proxy: New connection %s:%d (prefix=%s)' % (connection.address + (hexlify(prefix), )), LEVEL_INFO)
+
+    return (prefix, job.extranounce1 + hexlify(prefix), job.extranounce2_size - self._prefix_size)
+
+
+  def remove_connection(self, connection):
+    with self._lock:
+      if self._connections.get(connection.prefix) is connection:
+        del self._connections[connection.prefix]
+
+    log('Proxy: Closed connection %s:%d (accepted=%d rejected=%d)' % (connection.address + (connection.accepted_shares, connection.rejected_shares)), LEVEL_INFO)
+
+
+  def send_job(self, connection):
+    '''Sends the current difficulty and job to a (newly subscribed) connection.'''
+
+    # Sending may block, so never while holding the lock
+    with self._lock:
+      (sequence, line) = (self._job_sequence, self._notify_line(self._notify_params[:-1] + [ True ]))
+    connection.send_job(sequence, self._miner.subscription.difficulty, line)
+
+
+  def _notify_line(self, params):
+    return json.dumps(dict(id = None, method = 'mining.notify', params = params))
+
+
+  # Called by the miner (see Miner.set_scheduler)
+  def set_job(self, miner, job):
+    '''Called by the upstream miner when it has new work; fans it out downstream.'''
+
+    with self._lock:
+      if self._prefix_size is None:
+        self._prefix_size = min(self.PREFIX_SIZE, job.extranounce2_size - 1)
+
+      # Refuse the work (and any downstream miners; see subscribe)
+      if self._prefix_size < 1:
+        self._job_ready.set()
+        raise miner.MinerWarning('Upstream extranounce2 (%d bytes) is too small to share' % job.extranounce2_size, None)
+
+      # Forget jobs the server has told us are stale
+      valid_ids = miner.job_ids
+      clean_jobs = False
+      for job_id in list(self._jobs):
+        if job_id not in valid_ids:
+          del self._jobs[job_id]
+          clean_jobs = True
+      self._jobs[job.id] = job
+
+      self._notify_params = [ job.id, job.prevhash, job.coinb1, job.coinb2, job.merkle_branches, job.version, job.nbits, job.ntime, clean_jobs ]
+      self._job_sequence += 1
+      (sequence, line, difficulty) = (self._job_sequence, self._notify_line(self._notify_params), miner.subscription.difficulty)
+
+      # Only subscribed connections want work
+      connections = list(self._connections.values())
+
+    self._job_ready.set()
+
+    # Sending may block, so never while holding the lock (a connection may be
+    # waiting for it, eg. in submit)
+    for connection in connections:
+      connection.send_job(sequence, difficulty, line)
+
+    log('Proxy: New job: job_id=%s (%d connections)' % (job.id, len(connections)), LEVEL_DEBUG)
+
+
+  def submit(self, connection, params):
+    '''Checks a share from a connection's mining.submit and submits it upstream,
+       returning the error to reply with (or None).'''
+
+    if not isinstance(params, list) or len(params) != 5 or [ p for p in params if not isinstance(p, str) ]:
+      return [ 20, 'Malformed mining.submit', None ]
+
+    (worker_name, job_id, extranounce2, ntime, nounce) = params
+
+    if connection.prefix is None:
+      return [ 25, 'Not subscribed', None ]
+
+    with self._lock:
+      job = self._jobs.get(job_id)
+
+    if job is None:
+      return [ 21, 'Job not found', None ]
+
+    if len(extranounce2) != 2 * (job.extranounce2_size - self._prefix_size):
+      return [ 20, 'Wrong extranounce2 size', None ]
+
+    # We only hand out the job's ntime
+    if ntime != job.ntime:
+      return [ 20, 'Unsupported ntime', None ]
+
+    result = dict(job_id = job_id, extranounce2 = hexlify(connection.prefix) + extranounce2, ntime = ntime, nounce = nounce)
+    try:
+      result['pow'] = job.verify(result)
+    except Exception as e:
+      return [ 20, 'Malformed mining.submit (%s)' % e, None ]
+
+    if result['pow'] > job.target:
+      return [ 23, 'Low difficulty share', None ]
+
+    # Eg. stale (the job was superseded) or the upstream difficulty was raised
+    reason = self._miner.submit_share(result, job)
+    if reason:
+      return [ 21, 'Share dropped (%s)' % reason, None ]
+
+    return None
+
+
+  def start(self):
+    '''Connects upstream and starts accepting downstream miners in the background.'''
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((self._host, self._port))
+    server.listen(128)
+
+    log('Proxy listening on %s:%d' % (self._host, self._port), LEVEL_INFO)
+
+    self._miner.start()
+
+    def accept():
+      while True:
+        (sock, address) = server.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        StratumProxyConnection(self, address).connect(sock)
+
+    thread = threading.Thread(target = accept)
+    thread.daemon = True
+    thread.start()
+
+
+  def serve_forever(self):
+    '''Begins proxying. This method does not return.'''
+
+    self.start()
+
+    # Forever...
+    while True:
+      time.sleep(60)
+      with self._lock:
+        connections = list(self._connections.values())
+      log('Proxy: connections=%d accepted=%d rejected=%d (upstream accepted=%d rejected=%d)' % (len(connections), sum(c.accepted_shares for c in connections), sum(c.rejected_shares for c in connections), self._miner.accepted_shares, self._miner.rejected_shares), LEVEL_INFO)
+      self._miner.log_share_reasons()
+
+
+class CoordinatorConnection(SimpleJsonRpcConnection):
+  '''A RemoteWorker connected to a Coordinator.'''
+
+  def __init__(self, coordinator, address):
+    SimpleJsonRpcConnection.__init__(self, coordinator, address)
+
+    self._coordinator = coordinator
+
+    # Set by worker.hello
+    self._threads = 0
+    self._user_agent = None
+
+    # The hashrate (per thread) the worker has been reporting
+    self._hashrate = None
+
+    self._hash_count = 0
+    self._found_shares = 0
+
+  # Accessors
+  threads = property(lambda s: s._threads)
+  user_agent = property(lambda s: s._user_agent)
+  hashrate = property(lambda s: s._hashrate)
+  hash_count = property(lambda s: s._hash_count)
+  found_shares = property(lambda s: s._found_shares)
+
+
+  # Overridden from SimpleJsonRpcClient; these are requests from the worker
+  def handle_reply(self, request, reply):
+    try:
+      self._handle_request(reply)
+    except Exception as e:
+      log('Coordinator: Bad request from %s:%d (%s: %s)' % (self._address + (e.__class__.__name__, e)), LEVEL_ERROR)
+      self.reply(reply.get('id'), None, [ 20, 'Bad request', None ])
+      self.close()
+
+
+  def _handle_request(self, reply):
+    method = reply.get('method')
+    params = reply.get('params') or [ ]
+    message_id = reply.get('id')
+
+    # The types each method's params must have (bool is not a number here)
+    types = {
+      'worker.hello': (int, str),
+      'worker.found': (int, str),
+      'worker.done': (int, int, (int, float)),
+    }.get(method)
+
+    if types and not (isinstance(params, list) and len(params) == len(types) and
+                      all(isinstance(p, t) and not isinstance(p, bool) for (p, t) in zip(params, types))):
+      self.reply(message_id, None, [ 20, 'Malformed %s' % method, None ])
+
+    elif method == 'worker.hello':
+      if self._threads:
+        self.reply(message_id, None, [ 20, 'Already said hello', None ])
+        return
+
+      (self._threads, self._user_agent) = (max(1, params[0]), params[1])
+      self.reply(message_id, True)
+      self._coordinator.add_connection(self)
+
+    elif method == 'worker.found':
+      submitted = self._coordinator.found(self, params[0], params[1])
+      if submitted: self._found_shares += 1
+      self.reply(message_id, submitted)
+
+    elif method == 'worker.done':
+      (lease_id, hash_count, seconds) = params
+      if hash_count < 0:
+        self.reply(message_id, None, [ 20, 'Malformed %s' % method, None ])
+        return
+
+      self._hash_count += hash_count
+      if seconds > 0:
+        hashrate = hash_count / float(seconds)
+        if self._hashrate is None:
+          self._hashrate = hashrate
+        else:
+          self._hashrate = 0.5 * (self._hashrate + hashrate)
+      self.reply(message_id, True)
+      self._coordinator.done(self, lease_id, hash_count)
+
+    elif message_id is not None:
+      self.reply(message_id, None, [ 20, 'Unsupported method %s' % method, None ])
+
+
+class Coordinator(object):
+  '''Holds the pool connections (Miners) and hands out the work to RemoteWorkers
+     connected over TCP.
+
+     Workers never see the coinbase or merkle branches; each lease is just a
+     header (without the nounce), a target and a range of nounces. Workers report
+     back the nounces which meet the target (which are checked and submitted by
+     the Miner the lease came from) and ask for a new lease as they finish each
+     one. Leases from a worker which disconnects, or does not finish a lease in
+     LEASE_TIMEOUT seconds, are handed out again.
+
+     Work is shared between the miners by weight, as with MinerScheduler.
+
+     To use this class:
+       coordinator = Coordinator(port = 3334)
+       coordinator.add_miner(Miner(url1, username1, password1), weight = 3)
+       coordinator.add_miner(Miner(url2, username2, password2, ALGORITHM_SHA256D), weight = 1)
+       coordinator.serve_forever()
+  '''
+
+  class CoordinatorException(Exception): pass
+
+  # How long (in seconds) each lease should take a worker thread, at its reported hashrate
+  LEASE_SECONDS = 10
+
+  # How many nounces a lease has before we know a worker's hashrate
+  MIN_LEASE_SIZE = 16
+
+  # How long (in seconds) before an unfinished lease is handed out again
+  LEASE_TIMEOUT = 120
+
+  # How many leases to keep outstanding per worker thread (so no thread waits on the network)
+  LEASES_PER_THREAD = 2
+
+  def __init__(self, host = '', port = 3334, report_interval = 60):
+    self._host = host
+    self._port = port
+    self._report_interval = report_interval
+
+    self._lock = threading.RLock()
+    self._connections = [ ]
+
+    # Messages for the workers are collected under the lock and sent after it is
+    # released (see _send); this keeps them in order meanwhile
+    self._send_lock = threading.Lock()
+
+    # [ (miner, weight), ... ]
+    self._miners = [ ]
+
+    # Per miner: the job being mined and the next (extranounce2, nounce) to lease out
+    self._cursors = dict()
+
+    # Per miner: leases (job, extranounce2, nounce_start, nounce_count) to hand out again
+    self._returned = dict()
+
+    # Per miner: how many hashes workers have done for it (to share work by weight)
+    self._hash_counts = dict()
+
+    # By lease_id: (connection, miner, job, extranounce2, nounce_start, nounce_count, issued),
+    # and leases which were cancelled but which the worker has yet to report on
+    self._leases = dict()
+    self._cancelled = dict()
+    self._lease_id = 0
+
+    self._hash_t0 = None
+
+  # Accessors
+  miners = property(lambda s: [ m for (m, w) in s._miners ])
+  connections = property(lambda s: list(s._connections))
+  hash_counts = property(lambda s: dict(s._hash_counts))
+
+  @property
+  def hashrate(self):
+    '''The total hashrate the workers have reported since the first job.'''
+
+    if self._hash_t0 is None: return 0.0
+    dt = time.time() - self._hash_t0
+    if dt <= 0: return 0.0
+    return sum(c.hash_count for c in self.connections) / dt
+
+
+  def add_miner(self, miner, weight = 1):
+    '''Adds a miner, which receives weight / total_weight of the leases.'''
+
+    if weight <= 0:
+      raise self.CoordinatorException('Weight must be positive')
+
+    with self._lock:
+      self._miners.append((miner, weight))
+      self._hash_counts[miner] = 0
+      self._returned[miner] = [ ]
+      miner.set_scheduler(self)
+
+
+  # Called by the miner (see Miner.set_scheduler)
+  def set_job(self, miner, job):
+    '''Called by a miner when it has new work; leases for older work are replaced.'''
+
+    messages = [ ]
+    with self._send_lock:
+      with self._lock:
+        self._cursors[miner] = (job, 0, 0)
+        self._returned[miner] = [ ]
+        if self._hash_t0 is None: self._hash_t0 = time.time()
+
+        stale = [ lease_id for (lease_id, lease) in self._leases.items() if lease[1] is miner ]
+        self._replace_leases(stale, messages)
+
+        # Workers may have been waiting for any work at all
+        for connection in self._connections:
+          self._fill_leases(connection, messages)
+
+      self._send(messages)
+
+
+  def _send(self, messages):
+    '''Sends the (connection, method, params) notifications collected under the
+       lock; sending may block, and a worker may be waiting on the lock (eg. in
+       done), so this must be called without it (but with the send lock).'''
+
+    for (connection, method, params) in messages:
+      connection.notify(method, params)
+
+
+  def _next_range(self, miner, nounce_count):
+    '''Returns the next (job, extranounce2, nounce_start, nounce_count) to lease for miner.'''
+
+    if self._returned[miner]:
+      return self._returned[miner].pop()
+
+    (job, extranounce2, nounce) = self._cursors[miner]
+    nounce_count = min(nounce_count, 0x100000000 - nounce)
+    if nounce + nounce_count >= 0x100000000:
+      self._cursors[miner] = (job, extranounce2 + 1, 0)
+    else:
+      self._cursors[miner] = (job, extranounce2, nounce + nounce_count)
+
+    return (job, extranounce2, nounce, nounce_count)
+
+
+  def _issue_lease(self, connection, messages):
+    '''Leases the next range of work to connection (adding the worker.lease to
+       messages), from whichever miner is furthest behind its share of the work.
+       Returns whether there was any work.'''
+
+    # Count the work in progress, so a burst of leases is shared fairly too
+    leased = dict((m, self._hash_counts[m]) for (m, w) in self._miners)
+    for lease in self._leases.values():
+      leased[lease[1]] += lease[5]
+
+    miners = [ (leased[m] / float(w), i, m) for (i, (m, w)) in enumerate(self._miners) if m in self._cursors ]
+    if not miners: return False
+    miner = min(miners)[2]
+
+    nounce_count = self.MIN_LEASE_SIZE
+    if connection.hashrate:
+      nounce_count = max(nounce_count, int(connection.hashrate * self.LEASE_SECONDS))
+
+    (job, extranounce2, nounce_start, nounce_count) = self._next_range(miner, nounce_count)
+
+    self._lease_id += 1
+    lease_id = self._lease_id
+    self._leases[lease_id] = (connection, miner, job, extranounce2, nounce_start, nounce_count, time.time())
+
+    header_prefix = hexlify(job.header_prefix_bin(job.extranounce2_bin(extranounce2)))
+    messages.append((connection, 'worker.lease', [ lease_id, miner.algorithm, header_prefix, job.target, nounce_start, nounce_count ]))
+    return True
+
+
+  def _fill_leases(self, connection, messages):
+    '''Issues leases to connection until it has LEASES_PER_THREAD for each thread.'''
+
+    outstanding = len([ l for l in self._leases.values() if l[0] is connection ])
+    for i in range(connection.threads * self.LEASES_PER_THREAD - outstanding):
+      if not self._issue_lease(connection, messages): break
+
+
+  def _replace_leases(self, lease_ids, messages):
+    '''Cancels leases and gives their workers new ones; ranges from the current
+       job are handed out again.'''
+
+    connections = dict()
+    for lease_id in lease_ids:
+      (connection, miner, job, extranounce2, nounce_start, nounce_count, issued) = self._leases.pop(lease_id)
+      if self._cursors.get(miner, (None, ))[0] is job:
+        self._returned[miner].append((job, extranounce2, nounce_start, nounce_count))
+      connections.setdefault(connection, [ ]).append((lease_id, miner))
+
+    for (connection, cancelled) in connections.items():
+      if connection not in self._connections: continue
+
+      # The worker still reports how far it got (see done)
+      for (lease_id, miner) in cancelled:
+        self._cancelled[lease_id] = (connection, miner)
+
+      messages.append((connection, 'worker.cancel', [ [ lease_id for (lease_id, miner) in cancelled ] ]))
+      self._fill_leases(connection, messages)
+
+
+  def add_connection(self, connection):
+    messages = [ ]
+    with self._send_lock:
+      with self._lock:
+        self._connections.append(connection)
+        self._fill_leases(connection, messages)
+
+      self._send(messages)
+
+    log('Coordinator: New worker %s:%d (threads=%d, %s)' % (connection.address + (connection.threads, connection.user_agent)), LEVEL_INFO)
+
+
+  def remove_connection(self, connection):
+    messages = [ ]
+    with self._send_lock:
+      with self._lock:
+        if connection not in self._connections: return
+        self._connections.remove(connection)
+
+        # Hand its leases to everyone else
+        self._replace_leases([ i for (i, l) in self._leases.items() if l[0] is connection ], messages)
+        for (lease_id, (other, miner)) in list(self._cancelled.items()):
+          if other is connection: del self._cancelled[lease_id]
+        for other in self._connections:
+          self._fill_leases(other, messages)
+
+      self._send(messages)
+
+    log('Coordinator: Lost worker %s:%d (hashes=%d shares=%d)' % (connection.address + (connection.hash_count, connection.found_shares)), LEVEL_INFO)
+
+
+  def found(self, connection, lease_id, nounce):
+    '''A worker found nounce for a lease; returns whether it was submitted.'''
+
+    with self._lock:
+      lease = self._leases.get(lease_id)
+
+    if lease is None or lease[0] is not connection:
+      return False
+
+    (connection, miner, job, extranounce2, nounce_start, nounce_count, issued) = lease
+
+    result = dict(job_id = job.id, extranounce2 = hexlify(job.extranounce2_bin(extranounce2)), ntime = job.ntime, nounce = nounce)
+    try:
+      result['pow'] = job.verify(result)
+      if not (nounce_start <= int(nounce, 16) < nounce_start + nounce_count): raise ValueError('Nounce outside of lease')
+    except Exception as e:
+      log('Coordinator: Bad share from %s:%d (%s)' % (connection.address + (e, )), LEVEL_ERROR)
+      return False
+
+    if result['pow'] > job.target:
+      log('Coordinator: Low difficulty share from %s:%d' % connection.address, LEVEL_ERROR)
+      return False
+
+    return miner.submit(result, job)
+
+
+  def done(self, connection, lease_id, hash_count):
+    '''A worker finished (or abandoned a cancelled) lease; gives it another.'''
+
+    messages = [ ]
+    with self._send_lock:
+      with self._lock:
+        if self._leases.get(lease_id, (None, ))[0] is connection:
+          miner = self._leases.pop(lease_id)[1]
+        elif self._cancelled.get(lease_id, (None, ))[0] is connection:
+          miner = self._cancelled.pop(lease_id)[1]
+        else:
+          return
+
+        self._hash_counts[miner] += hash_count
+        self._fill_leases(connection, messages)
+
+      self._send(messages)
+
+
+  def _expire_leases(self):
+    while True:
+      time.sleep(self.LEASE_TIMEOUT / 4.0)
+
+      now = time.time()
+      messages = [ ]
+      with self._send_lock:
+        with self._lock:
+          expired = [ i for (i, l) in self._leases.items() if now - l[6] > self.LEASE_TIMEOUT ]
+          if expired:
+            log('Coordinator: %d leases expired' % len(expired), LEVEL_DEBUG)
+            self._replace_leases(expired, messages)
+
+        self._send(messages)
+
+
+  def start(self):
+    '''Connects every miner and starts accepting workers in the background.'''
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((self._host, self._port))
+    server.listen(128)
+
+    log('Coordinator listening on %s:%d' % (self._host, self._port), LEVEL_INFO)
+
+    for miner in self.miners:
+      miner.start()
+
+    def accept():
+      while True:
+        (sock, address) = server.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        CoordinatorConnection(self, address).connect(sock)
+
+    for target in (accept, self._expire_leases):
+      thread = threading.Thread(target = target)
+      thread.daemon = True
+      thread.start()
+
+
+  def serve_forever(self):
+    '''Begins coordinating. This method does not return.'''
+
+    self.start()
+
+    # Forever...
+    while True:
+      time.sleep(self._report_interval)
+      connections = self.connections
+      log('Coordinator: workers=%d threads=%d hashrate=%s' % (len(connections), sum(c.threads for c in connections), human_readable_hashrate(self.hashrate)), LEVEL_INFO)
+      hash_counts = self.hash_counts
+      for miner in self.miners:
+        log('  %s: hashes=%d accepted=%d rejected=%d filtered=%r' % (miner.url, hash_counts[miner], miner.accepted_shares, miner.rejected_shares, miner.filtered_shares), LEVEL_INFO)
+
+
+class RemoteWorker(SimpleJsonRpcClient):
+  '''Mines leases from a Coordinator (see Coordinator for the protocol); needs
+     no pool connection of its own.
+
+     To use this class:
+       worker = RemoteWorker('coordinator.local', 3334, threads = 4)
+       worker.serve_forever()
+  '''
+
+  # How often (in seconds) to log the hashrate
+  REPORT_INTERVAL = 60
+
+  def __init__(self, host, port = 3334, threads = 1):
+    SimpleJsonRpcClient.__init__(self)
+
+    self._host = host
+    self._port = port
+    self._threads = threads
+
+    # Leases waiting for a thread: [ (lease_id, algorithm, header_prefix_bin, target_bin, nounce_start, nounce_count), ... ],
+    # the lease ids being mined and those of them which were cancelled
+    self._condition = threading.Condition()
+    self._queue = [ ]
+    self._mining = set()
+    self._cancelled = set()
+
+    # A proof-of-work function for each algorithm
+    self._proofs_of_work = dict()
+
+    self._hash_count = 0
+    self._hash_t0 = None
+
+  # Accessors
+  threads = property(lambda s: s._threads)
+  hash_count = property(lambda s: s._hash_count)
+
+  @property
+  def hashrate(self):
+    if self._hash_t0 is None: return 0.0
+    dt = time.time() - self._hash_t0
+    if dt <= 0: return 0.0
+    return self._hash_count / dt
+
+
+  # Overridden from SimpleJsonRpcClient
+  def handle_reply(self, request, reply):
+    method = reply.get('method')
+    params = reply.get('params') or [ ]
+
+    if method == 'worker.lease':
+      (lease_id, algorithm, header_prefix, target, nounce_start, nounce_count) = params
+      if algorithm not in self._proofs_of_work:
+        self._proofs_of_work[algorithm] = SubscriptionByAlgorithm[algorithm]().ProofOfWork
+
+      with self._condition:
+        if self._hash_t0 is None: self._hash_t0 = time.time()
+        self._queue.append((lease_id, algorithm, unhexlify(header_prefix), unhexlify(target), nounce_start, nounce_count))
+        self._condition.notify()
+
+    elif method == 'worker.cancel':
+      lease_ids = set(params[0])
+      with self._condition:
+        # Queued leases are just dropped; those already finished are ignored
+        self._cancelled.update(lease_ids & self._mining)
+        dropped = [ l[0] for l in self._queue if l[0] in lease_ids ]
+        self._queue = [ l for l in self._queue if l[0] not in lease_ids ]
+
+      # The coordinator waits to hear about every cancelled lease (see Coordinator.done)
+      for lease_id in dropped:
+        self.send(method = 'worker.done', params = [ lease_id, 0, 0 ])
+
+    elif request and reply.get('error'):
+      raise self.RequestReplyWarning('Coordinator error', reply, request)
+
+
+  def _mine_lease(self, lease_id, algorithm, header_prefix_bin, target_bin, nounce_start, nounce_count):
+    '''Mines a lease, reporting each nounce which meets the target, and then how
+       many hashes were done (all of them, unless the lease was cancelled).'''
+
+    proof_of_work = self._proofs_of_work[algorithm]
+    cancelled = self._cancelled
+
+    t0 = time.time()
+    nounce_end = nounce_start + nounce_count
+    for nounce in range(nounce_start, nounce_end):
+      if lease_id in cancelled:
+        nounce_end = nounce
+        break
+
+      nounce_bin = struct.pack('<I', nounce)
+      if proof_of_work(header_prefix_bin + nounce_bin)[::-1] <= target_bin:
+        self.send(method = 'worker.found', params = [ lease_id, hexlify(nounce_bin[::-1]) ])
+
+    with self._condition:
+      self._hash_count += nounce_end - nounce_start
+      self._mining.discard(lease_id)
+      self._cancelled.discard(lease_id)
+
+    self.send(method = 'worker.done', params = [ lease_id, nounce_end - nounce_start, time.time() - t0 ])
+
+
+  def _work(self):
+    while True:
+      with self._condition:
+        while not self._queue:
+          self._condition.wait()
+        lease = self._queue.pop(0)
+        self._mining.add(lease[0])
+
+      try:
+        self._mine_lease(*lease)
+      except Exception as e:
+        log('ERROR: %s' % e, LEVEL_ERROR)
+
+
+  def start(self):
+    '''Connects to the coordinator and starts the mining threads.'''
+
+    log('Connecting to coordinator %s:%d' % (self._host, self._port), LEVEL_INFO)
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((hostname, port))
+    sock.connect((self._host, self._port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     self.connect(sock)
 
-    self.send(method = 'mining.subscribe', params = [ "%s/%s" % (USER_AGENT, '.'.join(str(p) for p in VERSION)) ])
+    for i in range(self._threads):
+      thread = threading.Thread(target = self._work)
+      thread.daemon = True
+      thread.start()
+
+    self.send(method = 'worker.hello', params = [ self._threads, '%s/%s' % (USER_AGENT, '.'.join(str(v) for v in VERSION)) ])
+
+
+  def serve_forever(self):
+    '''Begins mining for the coordinator. This method does not return.'''
+
+    self.start()
 
     # Forever...
     while True:
-      time.sleep(10)
+      time.sleep(self.REPORT_INTERVAL)
+      log('Hashrate: %s' % human_readable_hashrate(self.hashrate), LEVEL_INFO)
 
 
-def test_subscription():
-  '''Test harness for mining, using a known valid share.'''
-
-  log('TEST: Scrypt algorithm = %r' % SCRYPT_LIBRARY, LEVEL_DEBUG)
-  log('TEST: Testing Subscription', LEVEL_DEBUG)
+def test_subscription(library = None):
+  '''Test harness for mining, using a known valid share. Returns whether the
+     valid share was found using scrypt library (or the current library).'''
 
   subscription = SubscriptionScrypt()
 
+  # Test a specific library without changing the one in use
+  if library:
+    (library, subscription.ProofOfWork) = load_scrypt_library(library)
+
+  log('TEST: Scrypt algorithm = %r' % (library or SCRYPT_LIBRARY), LEVEL_DEBUG)
+  log('TEST: Testing Subscription', LEVEL_DEBUG)
+
   # Set up the subscription
   reply = json.loads('{"error": null, "id": 1, "result": [["mining.notify", "ae6812eb4cd7735a302a8a9dd95cf71f"], "f800880e", 4]}')
   log('TEST: %r' % reply, LEVEL_DEBUG)
@@ -876,9 +3114,427 @@ def test_subscription():
     log('TEST: found share - %r' % repr(result), LEVEL_DEBUG)
     break
 
-  valid = { 'ntime': '52c7b81a', 'nounce': '482601c0', 'extranounce2': '00000000', 'job_id': u'1db7' }
+  valid = { 'ntime': '52c7b81a', 'nounce': '482601c0', 'extranounce2': '00000000', 'job_id': '1db7' }
   log('TEST: Correct answer %r' % valid, LEVEL_DEBUG)
 
+  return all(result.get(k) == v for (k, v) in valid.items())
+
+
+def test_getblocktemplate():
+  '''Test harness for solo mining, against a loopback stand-in for a node. Returns
+     whether a block was submitted whose header matches the template's
+     previousblockhash and its own transactions (merkle root), and whether the
+     miner then moved on to the next block.'''
+
+  import http.server
+
+  log('TEST: Testing GetBlockTemplateMiner', LEVEL_DEBUG)
+
+  # The node's chain tip and (fake) mempool; any bytes will do as transactions
+  transactions = [ b'\x01' * 60, b'\x02' * 61 ]
+  target = '00' + 'f' * 62
+  node = dict(height = 100, prevhash = hexlify(sha256d(b'test')[::-1]), blocks = [ ])
+
+  def getblocktemplate(params):
+    return dict(version = 0x20000000, previousblockhash = node['prevhash'], height = node['height'], target = target,
+                bits = '1f00ffff', curtime = 0x52c7b81a, coinbasevalue = 5000000000, workid = 'w%d' % node['height'],
+                transactions = [ dict(data = hexlify(t), txid = hexlify(sha256d(t)[::-1])) for t in transactions ])
+
+  def submitblock(params):
+    block = unhexlify(params[0])
+    (header, coinbase) = (block[:80], block[81:len(block) - sum(len(t) for t in transactions)])
+
+    # Check the block as a node would (with its own merkle tree)
+    hashes = [ sha256d(coinbase) ] + [ sha256d(t) for t in transactions ]
+    while len(hashes) > 1:
+      if len(hashes) % 2: hashes.append(hashes[-1])
+      hashes = [ sha256d(hashes[i] + hashes[i + 1]) for i in range(0, len(hashes), 2) ]
+
+    if block[80] != 1 + len(transactions) or not block.endswith(b''.join(transactions)): return 'bad-txns'
+    if header[4:36] != unhexlify(node['prevhash'])[::-1]: return 'bad-prevblk'
+    if header[36:68] != hashes[0]: return 'bad-txnmrklroot'
+    if int(hexlify(sha256d(header)[::-1]), 16) > int(target, 16): return 'high-hash'
+    if params[1:] != [ dict(workid = 'w%d' % node['height']) ]: return 'bad-workid'
+
+    node['blocks'].append(header)
+    (node['height'], node['prevhash']) = (node['height'] + 1, hexlify(sha256d(header)[::-1]))
+    return None
+
+  class Node(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args): pass
+
+    def do_POST(self):
+      request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+      result = dict(getblocktemplate = getblocktemplate, submitblock = submitblock)[request['method']](request['params'])
+      body = json.dumps(dict(id = request['id'], result = result, error = None)).encode('utf-8')
+
+      self.send_response(200)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+  # Collects the miner's jobs, rather than mining each in its own thread
+  class Scheduler(object):
+    def __init__(self): self.jobs = [ ]
+    def set_job(self, miner, job): self.jobs.append(job)
+
+  server = http.server.HTTPServer(('127.0.0.1', 0), Node)
+  thread = threading.Thread(target = server.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+  try:
+    miner = GetBlockTemplateMiner('http://127.0.0.1:%d/' % server.server_address[1], 'test', 'test', ALGORITHM_SHA256D, payout_address = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')
+    scheduler = Scheduler()
+    miner.set_scheduler(scheduler)
+    miner._subscription.set_subscription('getblocktemplate', '', miner.EXTRANOUNCE2_SIZE)
+
+    miner._fetch_template()
+    job = scheduler.jobs[0]
+    for result in job.mine():
+      log('TEST: found block - %r' % result, LEVEL_DEBUG)
+      miner.submit(result, job)
+      break
+
+  finally:
+    server.shutdown()
+    server.server_close()
+
+  # One block accepted, and a job on top of it (so the old one is stale)
+  log('TEST: blocks=%d jobs=%d' % (len(node['blocks']), len(scheduler.jobs)), LEVEL_DEBUG)
+  return (len(node['blocks']) == 1 and miner.accepted_shares == 1 and len(scheduler.jobs) == 2 and
+          scheduler.jobs[1].prevhash != job.prevhash and miner.filter_share(result) == SHARE_STALE)
+
+
+def self_test(libraries = SCRYPT_LIBRARIES, cache_file = SELF_TEST_CACHE):
+  '''Runs test_subscription for each available scrypt library, skipping those
+     which have already passed (recorded in cache_file, if any).
+
+     This is slow (the pure Python scrypt especially), so is best run in a
+     background thread.
+  '''
+
+  def cache_key(library):
+    return '%s/%s python/%s %s' % (USER_AGENT, '.'.join(str(v) for v in VERSION), sys.version.split()[0], library)
+
+  passed = [ ]
+  if cache_file:
+    try:
+      passed = json.load(open(cache_file))
+    except Exception as e:
+      pass
+
+  tested = set()
+  for library in libraries:
+    try:
+      library = load_scrypt_library(library)[0]
+    except ImportError as e:
+      log('TEST: Not available: %r' % library, LEVEL_DEBUG)
+      continue
+
+    # Auto is one of the others
+    if library in tested: continue
+    tested.add(library)
+
+    if cache_key(library) in passed:
+      log('TEST: Passed (cached): %r' % library, LEVEL_DEBUG)
+      continue
+
+    t0 = time.time()
+    valid = test_subscription(library)
+
+    if not valid:
+      log('TEST: Failed: %r' % library, LEVEL_ERROR)
+      continue
+
+    log('TEST: Passed in %.3fs: %r' % (time.time() - t0, library), LEVEL_DEBUG)
+    passed.append(cache_key(library))
+
+    if cache_file:
+      try:
+        json.dump(passed, open(cache_file, 'w'))
+      except Exception as e:
+        log('TEST: Could not write %s (%s)' % (cache_file, e), LEVEL_DEBUG)
+
+
+# A known valid litecoin share (the one test_subscription finds); its header, the
+# job it came from (coinb1, coinb2 and merkle branches) and its scrypt proof-of-work
+TEST_HEADER = '02000000ffbf290b08dcc5963de665ee43ab7b7b89b045175bf90cff1e63a149319f2f1d5cc58f5e84aafc740d521b92a7bf72f4e56c4cc3ad1c2159f1d094f97ac34eee1ab8c7527282141bc0012648'
+TEST_COINB1 = '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff2503777d07062f503253482f0405b8c75208'
+TEST_COINB2 = '0b2f436f696e48756e74722f0000000001603f352a010000001976a914c633315d376c20a973a758f7422d67f7bfed9c5888ac00000000'
+TEST_MERKLE_BRANCHES = [ 'f0dbca1ee1a9f6388d07d97c1ab0de0e41acdf2edac4b95780ba0a1ec14103b3', '8e43fd2988ac40c5d97702b7e5ccdf5b06d58f0e0d323f74dd5082232c1aedf7', '1177601320ac928b8c145d771dae78a3901a089fa4aca8def01cbff747355818', '9f64f3b0d9edddb14be6f71c3ac2e80455916e207ffc003316c6a515452aa7b4', '2d0b54af60fad4ae59ec02031f661d026f2bb95e2eeb1e6657a35036c017c595' ]
+TEST_HEADER_POW = '00000437e55e80a11d6fcd7dc75430bd44ebf49e6544e63401b5f02bafdfa9f5'
+
+# Where the benchmark baselines are kept (see benchmark_compare)
+BENCHMARK_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark-baseline.json')
+
+# A plain Python loop, timed with the benchmarks to gauge how fast the host is
+BENCHMARK_CALIBRATION = 'calibration (python loop)'
+
+
+def benchmark_calibration(count = 1000):
+  '''Pure Python busy work, so benchmark_compare can tell a slow host from a
+     slow primitive.'''
+
+  total = 0
+  for i in range(0, count):
+    total = (total + i * i) & 0xffffffff
+  return total
+
+
+def benchmark_cases():
+  '''Returns the micro-benchmarks as a list of (name, function, check).
+
+     Each function is timed; check (if not None) is given the function's result
+     and returns whether it matches a known vector.
+  '''
+
+  header_bin = unhexlify(TEST_HEADER)
+
+  cases = [
+    (BENCHMARK_CALIBRATION, benchmark_calibration, None),
+    ('sha256d', lambda: sha256d(b''), lambda r: hexlify(r) == '5df6e0e2761359d30a8275058e299fcc0381534545f55cf43e41983f5d4c9456'),
+    ('swap_endian_word', lambda: swap_endian_word('1b148272'), lambda r: r == header_bin[72:76]),
+    ('swap_endian_words', lambda: swap_endian_words('0b29bfff96c5dc08ee65e63d7b7bab431745b089ff0cf95b49a1631e1d2f9f31'), lambda r: r == header_bin[4:36]),
+  ]
+
+  # Merkle roots get more expensive with each branch; the test job has 5
+  for count in (0, 5, 12):
+    branches = [ TEST_MERKLE_BRANCHES[i % 5] for i in range(0, count) ]
+    job = Job('1db7', '00' * 32, TEST_COINB1, TEST_COINB2, branches, '00000002', '1b148272', '52c7b81a', None, 'f800880e', 4, sha256d)
+    check = None
+    if count == 5: check = lambda r: r == header_bin[36:68]
+    cases.append(('merkle_root_bin (%d branches)' % count, lambda job = job: job.merkle_root_bin(b'\0' * 4), check))
+
+  subscription = SubscriptionSHA256D()
+  def set_difficulty():
+    subscription.set_difficulty(1)
+    return subscription.target
+  cases.append(('Subscription.set_difficulty', set_difficulty, lambda r: r == '00000000ffff0000000000000000000000000000000000000000000000000000'))
+
+  # The scrypt building blocks (RFC 7914 test vectors)
+  salsa_input = unhexlify('7e879a214f3ec9867ca940e641718f26baee555b8c61c1b50df846116dcd3b1dee24f319df9b3d8514121e4b5ac5aa3276021d2909c74829edebc68db8b8c25e')
+  def salsa():
+    B = bytearray(salsa_input)
+    salsa20_8(B)
+    return bytes(B)
+  cases.append(('salsa20_8', salsa, lambda r: hexlify(r) == 'a41f859c6608cc993b81cacb020cef05044b2181a2fd337dfd7b1c6396682f29b4393168e3c9e6bcfe6bc5b7a06d96bae424cc102c91745c24ad673dc7618f81'))
+
+  # scryptBlockMix and scryptROMix (N=16) share an input
+  block_input = unhexlify('f7ce0b653d2d72a4108cf5abe912ffdd777616dbbb27a70e8204f3ae2d0f6fad89f68f4811d1e87bcc3bd7400a9ffd29094f0184639574f39ae5a1315217bcd7894991447213bb226c25b54da86370fbcd984380374666bb8ffcb5bf40c254b067d27c51ce4ad5fed829c90b505a571b7f4d1cad6a523cda770e67bceaaf7e89')
+  def blockmix():
+    BY = bytearray(block_input) + bytearray(128)
+    blockmix_salsa8(BY, 0, 128, 1)
+    return bytes(BY[:128])
+  cases.append(('blockmix_salsa8', blockmix, lambda r: hexlify(r) == 'a41f859c6608cc993b81cacb020cef05044b2181a2fd337dfd7b1c6396682f29b4393168e3c9e6bcfe6bc5b7a06d96bae424cc102c91745c24ad673dc7618f8120edc975323881a80540f64c162dcd3c21077cfe5f8d5fe2b1a4168f953678b77d3b3d803b60e4ab920996e59b4d53b65d2a225877d5edf5842cb9f14eefe425'))
+
+  def smix_16():
+    B = bytearray(block_input)
+    smix(B, 0, 1, 16, bytearray(128 * 16), bytearray(256))
+    return bytes(B)
+  cases.append(('smix (N=16)', smix_16, lambda r: hexlify(r) == '79ccc193629debca047f0b70604bf6b62ce3dd4a9626e355fafc6198e6ea2b46d58413673b99b029d665c357601fb426a0b2f4bba200ee9f0a43d19b571a9c71ef1142e65d5a266fddca832ce59faa7cac0b9cf1be2bffca300d01ee387619c4ae12fd4438f203a0e4e1c47ec314861f4e9087cb33396a6873e8f9d2539a4b8e'))
+
+  cases.append(('scrypt (N=16, dkLen=64)', lambda: scrypt(b'', b'', 16, 1, 1, 64), lambda r: hexlify(r) == '77d6576238657b203b19ca42c18a0497f16b4844e3074ae8dfdffa3fede21442fcd0069ded0948f8326a753a0fc81f17e8d3e0fb2e0d3628cf35e20c38d18906'))
+
+  # Every available scrypt proof-of-work backend, on a real litecoin share
+  for library in SCRYPT_LIBRARIES:
+    if library == SCRYPT_LIBRARY_AUTO: continue
+    try:
+      (library, proof_of_work) = load_scrypt_library(library)
+    except ImportError as e:
+      continue
+    cases.append(('scrypt_proof_of_work (%s)' % library.split('(')[0].strip(), lambda pow = proof_of_work: pow(header_bin), lambda r: hexlify(r[::-1]) == TEST_HEADER_POW))
+
+  return cases
+
+
+def benchmark(min_time = 0.005, round_time = 0.05, rounds = 10):
+  '''Runs every benchmark_cases() case, returning (results, failures), where
+     results maps name to seconds per call and failures lists the names of
+     cases which did not match their known vector.
+
+     Each timing (with timeit, so perf_counter and without garbage collection)
+     takes at least min_time seconds, and each case gets about round_time
+     seconds of timings in each of the rounds. The rounds go through every case
+     in turn, so a slow spell on the host only affects some of each case's
+     timings, and the fastest is kept.
+  '''
+
+  results = dict()
+  failures = [ ]
+
+  # Check each case, and find how many calls take long enough to measure
+  cases = [ ]
+  for (name, function, check) in benchmark_cases():
+    if check and not check(function()):
+      failures.append(name)
+
+    timer = timeit.Timer(function)
+    count = 1
+    while True:
+      dt = timer.timeit(count)
+      if dt >= min_time: break
+      count *= 2
+    cases.append((name, timer, count, max(1, int(round_time / dt))))
+
+  for round in range(0, rounds):
+    for (name, timer, count, repeat) in cases:
+      result = min(timer.repeat(repeat, count)) / count
+      results[name] = min(results.get(name, result), result)
+
+  for (name, timer, count, repeat) in cases:
+    log('BENCHMARK: %s: %.3fus' % (name, 1000000 * results[name]), LEVEL_DEBUG)
+
+  return (results, failures)
+
+
+def benchmark_save(results, filename = BENCHMARK_BASELINE):
+  '''Saves benchmark results as a baseline for benchmark_compare.'''
+
+  baseline = dict(python = sys.version.split()[0], results = results)
+  json.dump(baseline, open(filename, 'w'), indent = 2, separators = (',', ': '), sort_keys = True)
+
+
+def benchmark_compare(results, filename = BENCHMARK_BASELINE, threshold = 0.25):
+  '''Returns the benchmarks which are slower than their baseline by more than
+     threshold (a fraction), as a list of (name, baseline, result).
+
+     If both have the calibration loop, the baseline is first scaled by how
+     much slower (or faster) the host ran it this time, so only primitives
+     which slowed down relative to plain Python are reported.
+  '''
+
+  baseline = json.load(open(filename))['results']
+
+  scale = 1.0
+  if BENCHMARK_CALIBRATION in baseline and BENCHMARK_CALIBRATION in results:
+    scale = results[BENCHMARK_CALIBRATION] / baseline[BENCHMARK_CALIBRATION]
+
+  regressions = [ ]
+  for (name, result) in sorted(results.items()):
+    if name == BENCHMARK_CALIBRATION or name not in baseline: continue
+    if result > baseline[name] * scale * (1 + threshold):
+      regressions.append((name, baseline[name] * scale, result))
+
+  return regressions
+
+
+# Where the tuned profiles (see autotune) are kept
+TUNING_PROFILES = os.path.join(os.path.expanduser('~'), '.nightminer-profile.json')
+
+# The fixed batch sizes autotune tries (as well as the adaptive default)
+AUTOTUNE_BATCH_SIZES = [ 1, 16, 256, 4096 ]
+
+
+def autotune_trial(algorithm, workers, processes, batch_size, duration):
+  '''Returns the hashrate of workers threads (each handing its hashing to a
+     process, if processes) mining a job which never finds a share, in batches of
+     batch_size (see Job.mine), over duration seconds.'''
+
+  subscription = SubscriptionByAlgorithm[algorithm]()
+  subscription.set_subscription('autotune', 'f800880e', 4)
+  subscription.set_target(0)
+  job = subscription.create_job('autotune', '00' * 32, TEST_COINB1, TEST_COINB2, TEST_MERKLE_BRANCHES, '00000002', '1b148272', '52c7b81a')
+  jobs = [ job.copy() for i in range(workers) ]
+
+  hasher = None
+  if processes: hasher = ProcessHasher(workers)
+
+  def run(index):
+    search = None
+    if hasher: search = hasher.searcher(algorithm)
+    for result in jobs[index].mine(nounce_start = index, nounce_stride = workers, batch_size = batch_size, search = search):
+      pass
+
+  try:
+    threads = [ threading.Thread(target = run, args = (i, )) for i in range(workers) ]
+    t0 = time.time()
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+
+    time.sleep(duration)
+    for job in jobs: job.stop()
+    for thread in threads: thread.join()
+
+    return sum(j.hash_count for j in jobs) / (time.time() - t0)
+  finally:
+    if hasher: hasher.close()
+
+
+def autotune(algorithm, max_workers = None, duration = 2.0, tolerance = 0.05):
+  '''Measures the hashrate of algorithm for worker counts (up to max_workers,
+     by default the CPU count), threads versus processes and batch sizes,
+     returning (profile, trials).
+
+     The profile is a dict of workers, processes, batch_size and hashrate; the
+     fewest workers (preferring threads) within tolerance (a fraction) of the
+     best hashrate, so extra workers must pay their way. Each trial is
+     (workers, processes, batch_size, hashrate).
+  '''
+
+  import multiprocessing
+  if max_workers is None: max_workers = multiprocessing.cpu_count()
+
+  counts = sorted(set([ 1, max_workers ] + [ 2 ** i for i in range(1, 8) if 2 ** i < max_workers ]))
+
+  trials = [ ]
+  def trial(workers, processes, batch_size):
+    hashrate = autotune_trial(algorithm, workers, processes, batch_size, duration)
+    log('Autotune: workers=%d processes=%s batch_size=%s hashrate=%s' % (workers, processes, batch_size, human_readable_hashrate(hashrate)), LEVEL_DEBUG)
+    trials.append((workers, processes, batch_size, hashrate))
+    return hashrate
+
+  for processes in (False, True):
+
+    # Find the best batch size with one worker; a batch must be quick enough to
+    # hash several times in a trial (so slow hashes only try the smallest)
+    (best_hashrate, best_batch_size) = (trial(1, processes, None), None)
+    for batch_size in AUTOTUNE_BATCH_SIZES:
+      if batch_size > max(1, best_hashrate * duration / 4): break
+      hashrate = trial(1, processes, batch_size)
+      if hashrate > best_hashrate:
+        (best_hashrate, best_batch_size) = (hashrate, batch_size)
+
+    for workers in counts[1:]:
+      trial(workers, processes, best_batch_size)
+
+  best_hashrate = max(t[3] for t in trials)
+  (workers, processes, batch_size, hashrate) = [ t for t in sorted(trials, key = lambda t: (t[0], t[1])) if t[3] >= (1 - tolerance) * best_hashrate ][0]
+
+  profile = dict(workers = workers, processes = processes, batch_size = batch_size, hashrate = hashrate)
+  return (profile, trials)
+
+
+def tuning_profile_key(algorithm):
+  '''Profiles are kept per host, algorithm (and scrypt library) and Python version.'''
+
+  key = '%s %s python/%s %s' % (socket.gethostname(), USER_AGENT, sys.version.split()[0], algorithm)
+  if algorithm == ALGORITHM_SCRYPT:
+    key += ' ' + load_scrypt_library(SCRYPT_LIBRARY or SCRYPT_LIBRARY_AUTO)[0]
+  return key
+
+
+def load_tuning_profile(algorithm, filename = TUNING_PROFILES):
+  '''Returns the profile saved by save_tuning_profile for this host and algorithm, or None.'''
+
+  try:
+    return json.load(open(filename)).get(tuning_profile_key(algorithm))
+  except Exception as e:
+    return None
+
+
+def save_tuning_profile(algorithm, profile, filename = TUNING_PROFILES):
+  '''Saves a profile from autotune for this host and algorithm.'''
+
+  profiles = dict()
+  try:
+    profiles = json.load(open(filename))
+  except Exception as e:
+    pass
+
+  profiles[tuning_profile_key(algorithm)] = profile
+  json.dump(profiles, open(filename, 'w'), indent = 2, separators = (',', ': '), sort_keys = True)
 
 
 # CLI for cpu mining
@@ -896,6 +3552,37 @@ if __name__ == '__main__':
 
   parser.add_argument('-a', '--algo', default = ALGORITHM_SCRYPT, choices = ALGORITHMS, help = 'hashing algorithm to use for proof of work')
 
+  parser.add_argument('-t', '--threads', type = int, help = 'number of mining threads (shared between all pools; default: from --autotune, or 1)')
+  parser.add_argument('--processes', action = 'store_true', default = None, help = 'each mining thread hashes in its own process (sidestepping the GIL)')
+  parser.add_argument('--threads-only', dest = 'processes', action = 'store_false', help = 'hash in the mining threads themselves (overriding a tuned profile)')
+  parser.add_argument('--batch-size', dest = 'batch_size', type = int, help = 'hash BATCH_SIZE nounces at a time (default: from --autotune, or adaptive)', metavar = 'BATCH_SIZE')
+  parser.add_argument('--autotune', action = 'store_true', help = 'measure the best threads, processes and batch size for this host and algorithm, save them for later runs and exit')
+  parser.add_argument('-M', '--pool', dest = 'pools', nargs = 4, action = 'append', default = [ ], help = 'an additional pool to mine concurrently; its share of the threads is WEIGHT / total weight (-o has a weight of 1)', metavar = ('URL', 'USERNAME:PASSWORD', 'ALGO', 'WEIGHT'))
+
+  parser.add_argument('--coinbase-address', dest = 'coinbase_address', help = 'solo mining (http:// urls, with getblocktemplate) pays the block reward to ADDRESS', metavar = 'ADDRESS')
+
+  parser.add_argument('--proxy', help = 'rather than mining, serve stratum to local miners on [HOST:]PORT over the single -o connection', metavar = '[HOST:]PORT')
+
+  parser.add_argument('--coordinator', help = 'rather than mining, lease work from every pool to remote --worker miners on [HOST:]PORT', metavar = '[HOST:]PORT')
+  parser.add_argument('--worker', help = 'mine leases from the --coordinator at HOST:PORT (instead of a pool)', metavar = 'HOST:PORT')
+
+  parser.add_argument('-s', '--share-rate', dest = 'share_rate', type = float, help = 'aim for this many shares per minute by suggesting difficulties to the server', metavar = 'SHARES')
+
+  parser.add_argument('--cpus', help = 'pin mining threads (round-robin) to these comma-separated CPUs', metavar = 'CPU,CPU,...')
+  parser.add_argument('--nice', type = int, help = 'increase the niceness of mining threads by NICE', metavar = 'NICE')
+  parser.add_argument('--idle', action = 'store_true', help = 'only mine when the CPU is otherwise idle (SCHED_IDLE)')
+  parser.add_argument('--duty-cycle', dest = 'duty_cycle', type = float, help = 'limit each mining thread to PERCENT of a CPU', metavar = 'PERCENT')
+
+  parser.add_argument('--verify-shares', dest = 'verify_shares', type = float, default = 0.0, help = 're-verify PERCENT of shares with the reference proof-of-work before submitting', metavar = 'PERCENT')
+
+  parser.add_argument('--trace', help = 'append job and share lifecycle timestamps to FILE', metavar = 'FILE')
+  parser.add_argument('--trace-summary', dest = 'trace_summary', help = 'show percentile latencies for each stage in trace FILE and exit', metavar = 'FILE')
+
+  parser.add_argument('--benchmark', action = 'store_true', help = 'time the hashing primitives (checking known vectors) and exit')
+  parser.add_argument('--benchmark-compare', dest = 'benchmark_compare', nargs = '?', const = BENCHMARK_BASELINE, help = 'with --benchmark, fail if any primitive is slower than in the baseline FILE', metavar = 'FILE')
+  parser.add_argument('--benchmark-save', dest = 'benchmark_save', nargs = '?', const = BENCHMARK_BASELINE, help = 'with --benchmark, save the results as the baseline FILE', metavar = 'FILE')
+  parser.add_argument('--benchmark-threshold', dest = 'benchmark_threshold', type = float, default = 25, help = 'how much slower (as a percentage) a primitive may be than the baseline', metavar = 'PERCENT')
+
   parser.add_argument('-B', '--background', action ='store_true', help = 'run in the background as a daemon')
 
   parser.add_argument('-q', '--quiet', action ='store_true', help = 'suppress non-errors')
@@ -918,14 +3605,82 @@ if __name__ == '__main__':
     else:
       try:
         (username, password) = options.userpass.split(':')
-      except Exception, e:
+      except Exception as e:
         message = 'Could not parse username:password for -O/--userpass'
 
+  # Get any additional pools
+  pools = [ ]
+  if options.url:
+    pools.append((options.url, username, password, options.algo, 1))
+
+  for (url, userpass, algo, weight) in options.pools:
+    try:
+      (pool_username, pool_password) = userpass.split(':')
+      if algo not in ALGORITHMS: raise ValueError('Unknown algorithm')
+      pools.append((url, pool_username, pool_password, algo, float(weight)))
+    except Exception as e:
+      message = 'Could not parse -M/--pool %s (%s)' % (url, e)
+
+  if options.threads is not None and options.threads < 1:
+    message = 'Must have at least one thread for -t/--threads'
+
+  if options.batch_size is not None and options.batch_size < 1:
+    message = '--batch-size must be at least one'
+
+  # Get the worker scheduling options
+  cpus = None
+  if options.cpus:
+    try:
+      cpus = [ int(c) for c in options.cpus.split(',') ]
+    except Exception as e:
+      message = 'Could not parse CPU list for --cpus'
+
+  duty_cycle = None
+  if options.duty_cycle is not None:
+    if not (0 < options.duty_cycle <= 100):
+      message = '--duty-cycle must be a percentage between 0 and 100'
+    duty_cycle = options.duty_cycle / 100.0
+
+  scheduling = cpus or options.nice or options.idle or duty_cycle
+
+  # Serving (or getting work from) other nightminers?
+  def parse_address(address):
+    try:
+      (host, port) = ([ '' ] + address.rsplit(':', 1))[-2:]
+      return (host, int(port))
+    except Exception as e:
+      return None
+
+  proxy_address = None
+  coordinator_address = None
+  worker_address = None
+
+  if len([ o for o in (options.proxy, options.coordinator, options.worker) if o ]) > 1:
+    message = 'Only one of --proxy, --coordinator and --worker may be used'
+
+  if options.coordinator:
+    coordinator_address = parse_address(options.coordinator)
+    if not coordinator_address:
+      message = 'Could not parse --coordinator %s' % options.coordinator
+
+  if options.worker:
+    worker_address = parse_address(options.worker)
+    if not worker_address or not worker_address[0]:
+      message = 'Could not parse --worker %s (must be HOST:PORT)' % options.worker
+
+  if options.proxy:
+    proxy_address = parse_address(options.proxy)
+    if not proxy_address:
+      message = 'Could not parse --proxy %s' % options.proxy
+
+    if len(pools) != 1 or urllib.parse.urlparse(pools[0][0]).scheme in ('http', 'https'):
+      message = '--proxy requires exactly one stratum url (-o)'
+
   # Was there an issue? Show the help screen and exit.
   if message:
     parser.print_help()
-    print
-    print message
+    print()
+    print(message)
     sys.exit(1)
 
   # Set the logging level
@@ -933,22 +3688,116 @@ if __name__ == '__main__':
   if options.protocol: DEBUG_PROTOCOL = True
   if options.quiet: QUIET = True
 
-  if DEBUG:
-    for library in SCRYPT_LIBRARIES:
-      set_scrypt_library(library)
-      test_subscription()
-
-    # Set us to a faster library if available
-    set_scrypt_library()
-    if options.algo == ALGORITHM_SCRYPT:
-      log('Using scrypt library %r' % SCRYPT_LIBRARY, LEVEL_DEBUG)
+  # Just summarizing a trace?
+  if options.trace_summary:
+    print('%-20s %8s %12s %12s %12s %12s' % ('stage', 'count', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)'))
+    for (name, count, p50, p90, p99, maximum) in trace_summary(options.trace_summary):
+      if count == 0:
+        print('%-20s %8d' % (name, count))
+      else:
+        print('%-20s %8d %12.3f %12.3f %12.3f %12.3f' % (name, count, 1000 * p50, 1000 * p90, 1000 * p99, 1000 * maximum))
+    sys.exit(0)
+
+  if options.trace:
+    set_trace_file(options.trace)
+
+  # Just benchmarking?
+  if options.benchmark:
+    (results, failures) = benchmark()
+
+    baseline = dict()
+    regressions = [ ]
+    if options.benchmark_compare:
+      baseline = json.load(open(options.benchmark_compare))['results']
+      regressions = benchmark_compare(results, options.benchmark_compare, options.benchmark_threshold / 100.0)
+
+    print('%-40s %14s %14s  %s' % ('primitive', 'time (us)', 'baseline (us)', 'status'))
+    for (name, result) in sorted(results.items()):
+      status = 'ok'
+      if name in failures:
+        status = 'WRONG RESULT'
+      elif name in [ r[0] for r in regressions ]:
+        status = 'REGRESSION'
+
+      reference = ''
+      if name in baseline: reference = '%.3f' % (1000000 * baseline[name])
+      print('%-40s %14.3f %14s  %s' % (name, 1000000 * result, reference, status))
+
+    if options.benchmark_save:
+      benchmark_save(results, options.benchmark_save)
+
+    if failures or regressions: sys.exit(1)
+    sys.exit(0)
+
+  # Just tuning?
+  if options.autotune:
+    (profile, trials) = autotune(options.algo, max_workers = options.threads)
+
+    print('%8s %10s %10s %16s %16s' % ('workers', 'mode', 'batch size', 'hashrate', 'per worker'))
+    for (workers, processes, batch_size, hashrate) in trials:
+      print('%8d %10s %10s %16s %16s' % (workers, ('threads', 'processes')[processes], batch_size or 'adaptive', human_readable_hashrate(hashrate), human_readable_hashrate(hashrate / workers)))
+
+    save_tuning_profile(options.algo, profile)
+    print()
+    print('Saved to %s: %d %s, batch size %s (%s)' % (TUNING_PROFILES, profile['workers'], ('threads', 'processes')[profile['processes']], profile['batch_size'] or 'adaptive', human_readable_hashrate(profile['hashrate'])))
+    sys.exit(0)
+
+  # Anything not given comes from the tuned profile (if any)
+  profile = dict()
+  if options.threads is None or options.processes is None or options.batch_size is None:
+    profile = load_tuning_profile(options.algo) or dict()
+    if profile: log('Using tuned profile: %r' % profile, LEVEL_DEBUG)
+
+  threads = options.threads or profile.get('workers', 1)
+  processes = options.processes
+  if processes is None: processes = profile.get('processes', False)
+  batch_size = options.batch_size or profile.get('batch_size')
 
   # The want a daemon, give them a daemon
   if options.background:
-    import os
     if os.fork() or os.fork(): sys.exit()
-  
+
+  # Test the scrypt libraries in the background, so we can get straight to work
+  if DEBUG:
+    if pools:
+      thread = threading.Thread(target = self_test)
+      thread.daemon = True
+      thread.start()
+    else:
+      self_test()
+
+  # Solo mining (http urls) talks getblocktemplate to a node; otherwise stratum
+  def create_miner(url, username, password, algo):
+    if urllib.parse.urlparse(url).scheme in ('http', 'https'):
+      return GetBlockTemplateMiner(url, username, password, algorithm = algo, payout_address = options.coinbase_address, verify_fraction = options.verify_shares / 100.0)
+    return Miner(url, username, password, algorithm = algo, shares_per_minute = options.share_rate, verify_fraction = options.verify_shares / 100.0)
+
+  try:
+    miners = [ (create_miner(url, username, password, algo), weight) for (url, username, password, algo, weight) in pools ]
+  except Exception as e:
+    parser.error(str(e))
+
   # Heigh-ho, heigh-ho, it's off to work we go...
-  if options.url:
-    miner = Miner(options.url, username, password, algorithm = options.algo)
-    miner.serve_forever()
+  if proxy_address:
+    (host, port) = proxy_address
+    StratumProxy(miners[0][0], host = host, port = port).serve_forever()
+
+  elif coordinator_address:
+    (host, port) = coordinator_address
+    coordinator = Coordinator(host = host, port = port)
+    for (miner, weight) in miners:
+      coordinator.add_miner(miner, weight = weight)
+    coordinator.serve_forever()
+
+  elif worker_address:
+    (host, port) = worker_address
+    RemoteWorker(host, port, threads = threads).serve_forever()
+
+  elif len(miners) == 1 and threads == 1 and not (scheduling or processes or batch_size):
+    miners[0][0].serve_forever()
+
+  elif miners:
+    scheduler = MinerScheduler(workers = threads, cpus = cpus, nice = options.nice, idle = options.idle, duty_cycle = duty_cycle, processes = processes, batch_size = batch_size)
+    for (miner, weight) in miners:
+      scheduler.add_miner(miner, weight = weight)
+    scheduler.serve_forever()